@@ -1,21 +1,33 @@
-# This script is used to patch a Docker container to use a specific data directory.
 #!/bin/bash
-# Check if the container name is provided
+# Apply the in-container patches from scripts/patches/ to a Docker container.
+# All pending patches are sent as one script over a single `docker exec`; each
+# applied patch leaves a marker /var/lib/vdesk/patches/<id>@<digest> in the
+# container so it is not applied twice (same convention as the web backend).
 if [ -z "$1" ]; then
   echo "Usage: $0 <container_name>"
   exit 1
 fi
 
-# # Change the ownership of the /data directory to the ubuntu user
-# docker exec $1 chown -R ubuntu:ubuntu /data
+PATCHES_DIR="$(cd "$(dirname "$0")" && pwd)/patches"
+MARKER_DIR=/var/lib/vdesk/patches
 
-# # kill all processes running as ubuntu user
-# docker exec $1 pkill -u ubuntu
-# # change the home directory of the ubuntu user to /data
-# docker exec $1 usermod -d /data -m ubuntu
+build_script() {
+  echo "set -u"
+  echo "mkdir -p $MARKER_DIR"
+  for f in "$PATCHES_DIR"/*.sh; do
+    [ -e "$f" ] || continue
+    id=$(basename "$f" .sh)
+    marker="$MARKER_DIR/$id@$(sha256sum "$f" | cut -c1-12)"
+    echo "if [ -e '$marker' ]; then echo 'VDESK-PATCH $id skip'; else"
+    echo "( set -e"
+    cat "$f"
+    echo ")"
+    echo "rc=\$?"
+    echo "[ \$rc -eq 0 ] && touch '$marker'"
+    echo "echo \"VDESK-PATCH $id \$rc\""
+    echo "[ \$rc -eq 0 ] || exit \$rc"
+    echo "fi"
+  done
+}
 
-# Copy the .bashrc and .profile files from /etc/skel to the home directory of the $USER user
-docker exec $1 cp /etc/skel/.bashrc /etc/skel/.profile /home/ubuntu/
-docker exec $1 chown ubuntu:ubuntu /home/ubuntu/.bashrc /home/ubuntu/.profile
-docker exec $1 chown ubuntu:ubuntu /home/ubuntu
-docker exec $1 sed -i "/\%sudo/s/\!\/bin\/su/\/usr\/bin\/dpkg, \!\/bin\/su/" /etc/sudoers
+build_script | docker exec -i -u root "$1" /bin/bash -s
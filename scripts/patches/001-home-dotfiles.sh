@@ -0,0 +1,4 @@
+# description: copy default shell dotfiles into the ubuntu home directory
+cp /etc/skel/.bashrc /etc/skel/.profile /home/ubuntu/
+chown ubuntu:ubuntu /home/ubuntu/.bashrc /home/ubuntu/.profile
+chown ubuntu:ubuntu /home/ubuntu
@@ -0,0 +1,2 @@
+# description: forbid dpkg for the sudo group alongside su
+sed -i "/\%sudo/s/\!\/bin\/su/\/usr\/bin\/dpkg, \!\/bin\/su/" /etc/sudoers
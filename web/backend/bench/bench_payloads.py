@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Serialization and transfer benchmark for the backend's largest payloads.
+
+Builds synthetic payloads shaped like the real ones (the container list, an
+exec log with inline outputs as written before the blob store, an exec log
+with previews, an audit page with output), then reports per payload:
+
+- serialization time with the stdlib `json` module (what JSONResponse does),
+  through pydantic + jsonable_encoder (the container list's old path) and
+  with the backend's json_bytes (orjson when installed);
+- body size raw, gzip and brotli (when installed), compression time and the
+  transfer time of each at --bandwidth Mbit/s.
+
+Example (from web/backend):
+
+    python bench/bench_payloads.py --containers 500 --exec-entries 400 --bandwidth 20
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402  (importing main has no side effects)
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+
+
+def container_list(n: int):
+    items = []
+    for i in range(n):
+        name = str(100000 + i)
+        items.append({
+            "name": name, "image": "10.233.0.132:8000/hdm/aiserver-cu12.4-nomachine:1.0",
+            "memory": "32G", "shm_size": "32gb", "cpus": "8", "gpus": [i % 8],
+            "port": main.compute_host_port_from_name(name), "swap": "8g",
+            "root_password": "x" * 15, "comment": f"desktop of user {i}", "template": "nomachine",
+            "revision": i % 7, "state": "Up 3 days", "ready": True,
+        })
+    return items
+
+
+def command_output(rng: random.Random, lines: int) -> str:
+    # repetitive tool output (nvidia-smi, apt) with some varying numbers
+    return "".join(f"|  {rng.randrange(8)}  NVIDIA A100-SXM4-40GB  On  | 0000:{rng.randrange(256):02X}:00.0 Off |"
+                   f"  {rng.randrange(30, 80)}C  P0  {rng.randrange(50, 400)}W / 400W |\n" for _ in range(lines))
+
+
+def exec_log(n: int, inline: bool, rng: random.Random):
+    entries = []
+    for i in range(n):
+        out = command_output(rng, 80)
+        entry = {"id": f"{i:032x}", "timestamp": "2026-10-19T03:00:00Z", "user": "admin",
+                 "cmd": "nvidia-smi", "returncode": 0}
+        if inline:
+            entry.update(stdout=out, stderr="")
+        else:
+            entry.update(stdout_size=len(out), stdout_preview=out[:main.EXEC_PREVIEW_CHARS],
+                         stdout_hash="%064x" % rng.getrandbits(256), stderr_size=0, stderr_preview="")
+        entries.append(entry)
+    return entries
+
+
+def audit_page(n: int, rng: random.Random):
+    items = [{"id": 100000 - i, "timestamp": "2026-10-19T03:00:00Z", "user": "admin",
+              "container": str(100000 + i % 50), "action": "exec", "detail": "apt-get install -y htop",
+              "returncode": 0, "duration": 1.234, "extra": None,
+              "stdout": command_output(rng, 20), "stderr": ""} for i in range(n)]
+    return {"items": items, "next": items[-1]["id"]}
+
+
+def timed(fn, repeat: int):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return result, best * 1000
+
+
+def stdlib_json(content) -> bytes:
+    # what starlette's JSONResponse does
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode()
+
+
+def bench(name: str, content, repeat: int, bandwidth: float, model=None):
+    row = {"payload": name}
+    body, row["json_ms"] = timed(lambda: stdlib_json(content), repeat)
+    if model is not None:
+        _, row["pydantic_json_ms"] = timed(lambda: stdlib_json(jsonable_encoder([model(**c) for c in content])), repeat)
+    _, row["fast_ms"] = timed(lambda: main.json_bytes(content), repeat)
+    row["raw_kb"] = round(len(body) / 1024, 1)
+    bytes_per_ms = bandwidth * 1e6 / 8 / 1000
+    row["raw_xfer_ms"] = round(len(body) / bytes_per_ms, 1)
+    encodings = ["gzip"] + (["br"] if main.brotli is not None else [])
+    for enc in encodings:
+        packed, ms = timed(lambda: main.compress_body(body, enc), repeat)
+        row[f"{enc}_kb"] = round(len(packed) / 1024, 1)
+        row[f"{enc}_ms"] = round(ms, 2)
+        row[f"{enc}_xfer_ms"] = round(len(packed) / bytes_per_ms + ms, 1)
+    for k in ("json_ms", "pydantic_json_ms", "fast_ms"):
+        if k in row:
+            row[k] = round(row[k], 2)
+    return row
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--containers", type=int, default=500)
+    parser.add_argument("--exec-entries", type=int, default=400)
+    parser.add_argument("--audit-items", type=int, default=1000)
+    parser.add_argument("--bandwidth", type=float, default=20, help="link speed in Mbit/s for transfer estimates")
+    parser.add_argument("--repeat", type=int, default=5, help="best of N timings")
+    parser.add_argument("--json", type=Path, help="write results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    rows = [
+        bench("containers", container_list(args.containers), args.repeat, args.bandwidth, model=main.ContainerInfo),
+        bench("exec-logs (inline)", exec_log(args.exec_entries, True, rng), args.repeat, args.bandwidth),
+        bench("exec-logs (preview)", exec_log(args.exec_entries, False, rng), args.repeat, args.bandwidth),
+        bench("audit (output)", audit_page(args.audit_items, rng), args.repeat, args.bandwidth),
+    ]
+    print(f"json_bytes backend: {'orjson' if main.orjson is not None else 'json'}, "
+          f"brotli: {'yes' if main.brotli is not None else 'not installed'}, bandwidth {args.bandwidth} Mbit/s")
+    cols = list(dict.fromkeys(k for r in rows for k in r))
+    widths = [max(len(c), *(len(str(r.get(c, "-"))) for r in rows)) for c in cols]
+    print("  ".join(c.ljust(w) for c, w in zip(cols, widths)))
+    for r in rows:
+        print("  ".join(str(r.get(c, "-")).ljust(w) for c, w in zip(cols, widths)))
+    if args.json:
+        with args.json.open("w") as f:
+            json.dump({"config": vars(args), "results": rows}, f, indent=2, default=str)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_())
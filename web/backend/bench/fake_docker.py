@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""Fake `docker` / `docker compose` CLI for benchmarks.
+
+Implements the subset of the CLI the backend calls. Container state lives in
+$FAKE_DOCKER_STATE (one file per existing container holding its status) and
+every invocation appends a line to $FAKE_DOCKER_STATE/spawns.log.
+
+Latencies are configured with FAKE_DOCKER_LATENCY, e.g.
+"ps=0.05,compose=0.5,exec=0.1" (seconds, per subcommand; `default` for the rest).
+FAKE_DOCKER_EXEC_OUTPUT sets the number of stdout bytes an exec produces.
+`logs` prints FAKE_DOCKER_LOG_LINES existing lines (every fifth on stderr) and,
+with -f, one more every FAKE_DOCKER_LOG_INTERVAL seconds until the container
+stops.
+"""
+import hashlib
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+STATE = Path(os.environ.get("FAKE_DOCKER_STATE", "/tmp/fake-docker"))
+CONTAINERS = STATE / "containers"
+
+
+def latency(cmd: str) -> float:
+    spec = {}
+    for part in os.environ.get("FAKE_DOCKER_LATENCY", "").split(","):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            spec[k.strip()] = float(v)
+    return spec.get(cmd, spec.get("default", 0.0))
+
+
+def record_spawn(argv):
+    STATE.mkdir(parents=True, exist_ok=True)
+    line = (" ".join(argv[:3]) + "\n").encode()
+    fd = os.open(str(STATE / "spawns.log"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def container_file(name: str) -> Path:
+    return CONTAINERS / name
+
+
+def set_status(name: str, status: str):
+    CONTAINERS.mkdir(parents=True, exist_ok=True)
+    container_file(name).write_text(status)
+
+
+def compose(args):
+    # docker compose -f <path> <cmd> ...
+    compose_path = Path(args[args.index("-f") + 1])
+    project = compose_path.parent.name
+    cname = f"{project}-my_ws-1"
+    rest = args[args.index("-f") + 2:]
+    cmd = rest[0] if rest else ""
+    time.sleep(latency("compose"))
+    if cmd in ("up", "start", "restart"):
+        set_status(cname, "Up 1 second")
+        print(f" Container {cname}  Started")
+    elif cmd == "stop":
+        if container_file(cname).exists():
+            set_status(cname, "Exited (0) 1 second ago")
+        print(f" Container {cname}  Stopped")
+    elif cmd == "down":
+        container_file(cname).unlink(missing_ok=True)
+        print(f" Container {cname}  Removed")
+    return 0
+
+
+def container_id(name: str) -> str:
+    return hashlib.sha256(name.encode()).hexdigest()
+
+
+def render_format(fmt: str, name: str, status: str) -> str:
+    project = name.rsplit("-", 2)[0] if name.count("-") >= 2 else ""
+    out = fmt.replace("{{.Names}}", name).replace("{{.Status}}", status)
+    out = out.replace("{{.ID}}", container_id(name)[:12])
+    out = re.sub(r'\{\{\.Label "com\.docker\.compose\.project"\}\}', project, out)
+    return out
+
+
+def ps(args):
+    time.sleep(latency("ps"))
+    fmt = args[args.index("--format") + 1] if "--format" in args else "{{.Names}}\t{{.Status}}"
+    if CONTAINERS.exists():
+        for f in sorted(CONTAINERS.iterdir()):
+            status = f.read_text()
+            if "-a" not in args and not status.startswith("Up"):
+                continue
+            print(render_format(fmt, f.name, status))
+    return 0
+
+
+def exec_(args):
+    # docker exec [-u user] [-i] [-t] <container> cmd...
+    i = 0
+    while i < len(args) and args[i].startswith("-"):
+        i += 2 if args[i] in ("-u", "--user", "-w", "-e") else 1
+    name = args[i] if i < len(args) else ""
+    time.sleep(latency("exec"))
+    if not container_file(name).exists():
+        print(f"Error response from daemon: No such container: {name}", file=sys.stderr)
+        return 1
+    size = int(os.environ.get("FAKE_DOCKER_EXEC_OUTPUT", "64"))
+    line = "fake output " * 8 + "\n"
+    sys.stdout.write((line * (size // len(line) + 1))[:size])
+    return 0
+
+
+def logs(args):
+    # docker logs [-f] [--tail N] [--timestamps] <container>
+    follow = "-f" in args or "--follow" in args
+    stamps = "--timestamps" in args or "-t" in args
+    tail = int(args[args.index("--tail") + 1]) if "--tail" in args else None
+    name = args[-1]
+    time.sleep(latency("logs"))
+    if not container_file(name).exists():
+        print(f"Error response from daemon: No such container: {name}", file=sys.stderr)
+        return 1
+
+    def emit(i, t):
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t)) + ".%09dZ " % int(t % 1 * 1e9) if stamps else ""
+        out = sys.stderr if i % 5 == 4 else sys.stdout
+        out.write(f"{stamp}{name} log line {i}\n")
+        out.flush()
+
+    total = int(os.environ.get("FAKE_DOCKER_LOG_LINES", "100"))
+    now = time.time()
+    for i in range(max(0, total - tail) if tail is not None else 0, total):
+        emit(i, now - total + i)
+    interval = float(os.environ.get("FAKE_DOCKER_LOG_INTERVAL", "1"))
+    i = total
+    while follow and container_file(name).exists() and container_file(name).read_text().startswith("Up"):
+        time.sleep(interval)
+        emit(i, time.time())
+        i += 1
+    return 0
+
+
+def inspect(args):
+    time.sleep(latency("inspect"))
+    names = [a for a in args if not a.startswith("-") and "{{" not in a]
+    for name in names:
+        print(container_id(name))
+    return 0
+
+
+def rm(args):
+    time.sleep(latency("rm"))
+    for name in (a for a in args if not a.startswith("-")):
+        container_file(name).unlink(missing_ok=True)
+    return 0
+
+
+def main(argv):
+    record_spawn(argv)
+    if not argv:
+        return 0
+    cmd, args = argv[0], argv[1:]
+    handlers = {"compose": compose, "ps": ps, "exec": exec_, "inspect": inspect, "rm": rm,
+                "logs": logs}
+    if cmd in handlers:
+        return handlers[cmd](args)
+    time.sleep(latency("default"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
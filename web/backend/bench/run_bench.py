@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""Benchmark / load test for the vdesk backend against a fake docker CLI.
+
+Starts the backend (uvicorn) in a scratch directory with N synthetic container
+dirs and `bench/fake_docker.py` first on PATH, drives the API at the given
+concurrency and reports the time until /readyz answers, then latency
+percentiles, throughput, docker process spawns and server RSS per scenario.
+
+Example (from web/backend):
+
+    python bench/run_bench.py --containers 200 --concurrency 8 --requests 200 \
+        --latency ps=0.02,compose=0.2,exec=0.05 --json results.json
+
+Compare a later run against a saved one with `--baseline results.json`; the
+exit status is 1 when a scenario's p50 regresses more than --max-regression.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import bcrypt
+import yaml
+
+BENCH_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = BENCH_DIR.parent
+PROJECT_ROOT = BACKEND_DIR.parent.parent
+TEMPLATE_COMPOSE = PROJECT_ROOT / "scripts" / "docker-compose.yml.example"
+
+SCENARIOS = ("list", "create", "modify", "exec", "exec-ws")
+BENCH_USER = "bench"
+BENCH_PASSWORD = "bench"
+
+
+def container_names(count: int, start: int = 100000):
+    return [str(start + i) for i in range(count)]
+
+
+def setup_workdir(workdir: Path, count: int):
+    """Create the fake docker shim, users file and `count` synthetic container dirs."""
+    bin_dir = workdir / "bin"
+    bin_dir.mkdir()
+    shim = bin_dir / "docker"
+    shim.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{BENCH_DIR / "fake_docker.py"}" "$@"\n')
+    shim.chmod(0o755)
+
+    users = {BENCH_USER: bcrypt.hashpw(BENCH_PASSWORD.encode(), bcrypt.gensalt(4)).decode()}
+    (workdir / "users.json").write_text(json.dumps(users))
+
+    with TEMPLATE_COMPOSE.open() as f:
+        template = yaml.safe_load(f)
+    containers_dir = workdir / "containers"
+    state_dir = workdir / "docker" / "containers"
+    state_dir.mkdir(parents=True)
+    for name in container_names(count):
+        d = containers_dir / name
+        d.mkdir(parents=True)
+        svc = template["services"]["my_ws"]
+        svc["ports"] = [f"{(int(name[0]) + int(name[1])) % 6}{name[-4:]}:4000"]
+        with (d / "docker-compose.yml").open("w") as f:
+            f.write(f"# comment: synthetic {name}\n")
+            yaml.safe_dump(template, f, sort_keys=False)
+        # all synthetic desktops are running
+        (state_dir / f"{name}-my_ws-1").write_text("Up 2 hours")
+    return bin_dir
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir: Path, bin_dir: Path, port: int, latency: str, exec_output: int):
+    env = dict(os.environ)
+    env.update({
+        "PATH": f"{bin_dir}{os.pathsep}{env.get('PATH', '')}",
+        "FAKE_DOCKER_STATE": str(workdir / "docker"),
+        "FAKE_DOCKER_LATENCY": latency,
+        "FAKE_DOCKER_EXEC_OUTPUT": str(exec_output),
+        "VDESK_CONTAINERS_DIR": str(workdir / "containers"),
+        "VDESK_LOG_DIR": str(workdir / "logs"),
+        "VDESK_USERS_FILE": str(workdir / "users.json"),
+        "VDESK_LOCK_DIR": str(workdir / "locks"),
+        "VDESK_BLOB_DIR": str(workdir / "blobs"),
+        "VDESK_RECONCILE_ON_STARTUP": "0",
+        # fake containers publish no desktop port; don't wait for it on create
+        "VDESK_READY_TIMEOUT": "0",
+    })
+    log = (workdir / "server.out").open("w")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=str(BACKEND_DIR), env=env, stdout=log, stderr=subprocess.STDOUT)
+    started = time.monotonic()
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited, see {workdir / 'server.out'}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/readyz", timeout=1) as resp:
+                profile = json.loads(resp.read()).get("profile", {})
+                return proc, {"ready_s": round(time.monotonic() - started, 3), "profile": profile}
+        except (OSError, ValueError):
+            # not listening yet, or 503 while starting
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("server did not become ready within 30s")
+
+
+def rss_kb(pid: int):
+    """Return (current RSS, peak RSS) of a process in kB from /proc."""
+    cur = peak = None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    cur = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1])
+    except OSError:
+        pass
+    return cur, peak
+
+
+def spawn_count(workdir: Path) -> int:
+    try:
+        with (workdir / "docker" / "spawns.log").open("rb") as f:
+            return sum(1 for _ in f)
+    except OSError:
+        return 0
+
+
+class Client:
+    def __init__(self, base: str):
+        self.base = base
+        self.token = None
+
+    def request(self, method: str, path: str, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base + path, data=data, method=method)
+        req.add_header("Content-Type", "application/json")
+        if self.token:
+            req.add_header("Authorization", f"Bearer {self.token}")
+        with urllib.request.urlopen(req, timeout=120) as resp:
+            return resp.status, resp.read()
+
+    def login(self):
+        _, body = self.request("POST", "/api/login", {"username": BENCH_USER, "password": BENCH_PASSWORD})
+        self.token = json.loads(body)["token"]
+
+
+def make_ops(scenario: str, client: Client, names, requests: int):
+    """Return a list of zero-argument callables, one per request."""
+    if scenario == "list":
+        return [lambda: client.request("GET", "/api/containers") for _ in range(requests)]
+    if scenario == "create":
+        new_names = container_names(requests, start=800000)
+        return [lambda n=n: client.request("POST", "/api/containers", {
+            "name": n, "image": "bench/ubuntu-desktop-nomachine:1", "cpus": 2, "memory": "4g", "gpus": [0],
+        }) for n in new_names]
+    if scenario == "modify":
+        body = {"memory": "8g", "shm_size": None, "gpus": None, "swap": None, "root_password": None,
+                "comment": None, "cpus": None}
+        return [lambda n=names[i % len(names)]: client.request("PUT", f"/api/containers/{n}", body)
+                for i in range(requests)]
+    if scenario == "exec":
+        return [lambda n=names[i % len(names)]: client.request("POST", f"/api/containers/{n}/exec",
+                                                              {"cmd": "nvidia-smi"})
+                for i in range(requests)]
+    if scenario == "exec-ws":
+        from websockets.sync.client import connect
+
+        def ws_exec(n):
+            url = f"{client.base.replace('http', 'ws', 1)}/api/containers/{n}/exec-ws?token={client.token}"
+            with connect(url, open_timeout=30) as ws:
+                ws.send(json.dumps({"cmd": "nvidia-smi"}))
+                while True:
+                    msg = json.loads(ws.recv(timeout=120))
+                    if msg.get("type") in ("exit", "error"):
+                        return 200, msg
+        return [lambda n=names[i % len(names)]: ws_exec(n) for i in range(requests)]
+    raise ValueError(scenario)
+
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+def run_scenario(scenario: str, client: Client, names, requests: int, concurrency: int,
+                 workdir: Path, server_pid: int) -> dict:
+    ops = make_ops(scenario, client, names, requests)
+    latencies, errors = [], 0
+
+    def timed(op):
+        start = time.perf_counter()
+        try:
+            op()
+            return time.perf_counter() - start, None
+        except (urllib.error.URLError, OSError, Exception) as e:
+            return time.perf_counter() - start, e
+
+    spawns_before = spawn_count(workdir)
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for elapsed, err in pool.map(timed, ops):
+            latencies.append(elapsed)
+            if err is not None:
+                errors += 1
+    wall = time.perf_counter() - wall_start
+    rss, peak = rss_kb(server_pid)
+    return {
+        "scenario": scenario,
+        "requests": len(ops),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+        "throughput_rps": round(len(ops) / wall, 2) if wall else 0.0,
+        "spawns": spawn_count(workdir) - spawns_before,
+        "spawns_per_request": round((spawn_count(workdir) - spawns_before) / max(1, len(ops)), 2),
+        "rss_kb": rss,
+        "peak_rss_kb": peak,
+    }
+
+
+def print_table(results):
+    cols = ("scenario", "requests", "errors", "p50_ms", "p99_ms", "mean_ms", "throughput_rps",
+            "spawns_per_request", "rss_kb", "peak_rss_kb")
+    widths = [max(len(c), *(len(str(r[c])) for r in results)) for c in cols]
+    print("  ".join(c.ljust(w) for c, w in zip(cols, widths)))
+    for r in results:
+        print("  ".join(str(r[c]).ljust(w) for c, w in zip(cols, widths)))
+
+
+def compare(results, baseline_path: Path, max_regression: float) -> bool:
+    """Print p50/p99 ratios against a saved run; return False on a regression."""
+    with baseline_path.open() as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    ok = True
+    for r in results:
+        base = baseline.get(r["scenario"])
+        if not base or not base["p50_ms"]:
+            continue
+        ratio = r["p50_ms"] / base["p50_ms"]
+        flag = ""
+        if ratio > 1 + max_regression:
+            flag = "  REGRESSION"
+            ok = False
+        print(f"{r['scenario']:<8} p50 {base['p50_ms']}ms -> {r['p50_ms']}ms (x{ratio:.2f})  "
+              f"p99 {base['p99_ms']}ms -> {r['p99_ms']}ms{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--containers", type=int, default=50, help="synthetic container dirs")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=50, help="requests per scenario")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--latency", default="ps=0.01,compose=0.05,exec=0.02,inspect=0.01",
+                        help="fake docker latencies in seconds per subcommand")
+    parser.add_argument("--exec-output", type=int, default=4096, help="bytes of stdout per fake exec")
+    parser.add_argument("--json", type=Path, help="write results to this file")
+    parser.add_argument("--baseline", type=Path, help="compare against a previous --json file")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed p50 slowdown (0.2 = 20%%)")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    for s in scenarios:
+        if s not in SCENARIOS:
+            parser.error(f"unknown scenario {s}")
+
+    workdir = Path(tempfile.mkdtemp(prefix="vdesk-bench-"))
+    server = None
+    try:
+        bin_dir = setup_workdir(workdir, args.containers)
+        port = free_port()
+        server, startup = start_server(workdir, bin_dir, port, args.latency, args.exec_output)
+        client = Client(f"http://127.0.0.1:{port}")
+        client.login()
+        names = container_names(args.containers)
+        results = []
+        for s in scenarios:
+            results.append(run_scenario(s, client, names, args.requests, args.concurrency, workdir, server.pid))
+        print(f"containers={args.containers} concurrency={args.concurrency} latency={args.latency}")
+        print(f"ready after {startup['ready_s']}s (server startup: "
+              + ", ".join(f"{k} {v}s" for k, v in startup["profile"].items()) + ")")
+        print_table(results)
+        if args.json:
+            with args.json.open("w") as f:
+                json.dump({"config": vars(args), "startup": startup, "results": results}, f, indent=2, default=str)
+        if args.baseline and not compare(results, args.baseline, args.max_regression):
+            return 1
+        return 0
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        if args.keep:
+            print(f"scratch directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,28 +1,150 @@
 from pathlib import Path
 import shutil
 import subprocess
-import yaml
 from typing import List, Optional
 from fastapi import FastAPI, HTTPException
 from fastapi import Request, Response
 from pydantic import BaseModel, Field
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 import logging
-from logging.handlers import RotatingFileHandler
-from datetime import datetime
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from datetime import datetime, timezone
 import uuid
+import copy
 import time
 from typing import Dict
 import os
 import json
-import bcrypt
 import secrets
 import asyncio
 import shlex
+import socket
+import signal
+import hashlib
+import gzip
+import sqlite3
+import threading
+import contextvars
+import fcntl
+from contextlib import contextmanager, asynccontextmanager, nullcontext
+import queue
+import importlib
+from types import MappingProxyType
+from collections import deque
 from fastapi import WebSocket, WebSocketDisconnect
 from asyncio.subprocess import PIPE
+import anyio
+try:
+    import zstandard
+except ImportError:  # optional: exec output blobs fall back to gzip
+    zstandard = None
+try:
+    import orjson
+except ImportError:  # optional: responses fall back to the json module
+    orjson = None
+try:
+    import brotli
+except ImportError:  # optional: responses are compressed with gzip only
+    brotli = None
 
-app = FastAPI(title="vdesk-backend")
+
+
+class _LazyModule:
+    """Stand-in for a module that is imported on first attribute access, so
+    importing main doesn't pay for modules only some requests need."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+yaml = _LazyModule("yaml")
+bcrypt = _LazyModule("bcrypt")
+
+
+# Responses
+#
+# JSON is serialized with orjson when it is installed. Large payloads (the
+# container list, exec logs, audit queries) go through encode_response, which
+# compresses bodies over COMPRESS_MIN_SIZE bytes with brotli or gzip, whichever
+# the client accepts (brotli preferred when the module is installed).
+COMPRESS_MIN_SIZE = int(os.environ.get("VDESK_COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def json_bytes(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return json_bytes(content)
+
+
+def _accepted_encoding(request: Request) -> Optional[str]:
+    accepted = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = part.partition(";")
+        q = params.strip()
+        try:
+            if q.startswith("q=") and float(q[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def encode_response(request: Request, body: bytes, headers: Optional[dict] = None,
+                    cache: Optional[dict] = None, media_type: str = "application/json") -> Response:
+    """Response for an already serialized body, compressed when the client
+    accepts it and the body is large enough. `cache` (encoding -> bytes) keeps
+    compressed variants of a body that is served repeatedly."""
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    encoding = _accepted_encoding(request) if len(body) >= COMPRESS_MIN_SIZE else None
+    if encoding is not None:
+        encoded = cache.get(encoding) if cache is not None else None
+        if encoded is None:
+            encoded = compress_body(body, encoding)
+            if cache is not None:
+                cache[encoding] = encoded
+        headers["Content-Encoding"] = encoding
+        body = encoded
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # startup() and shutdown() are defined at the end of this module
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
+
+app = FastAPI(title="vdesk-backend", lifespan=lifespan, default_response_class=FastJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -35,31 +157,225 @@ app.add_middleware(
 THIS_FILE = Path(__file__).resolve()
 WEB_ROOT = THIS_FILE.parent.parent  # web/
 PROJECT_ROOT = WEB_ROOT.parent  # project root (vdesk)
-CONTAINERS_DIR = WEB_ROOT / "containers"
+CONTAINERS_DIR = Path(os.environ.get("VDESK_CONTAINERS_DIR", str(WEB_ROOT / "containers")))
 TEMPLATE_COMPOSE = PROJECT_ROOT / "scripts" / "docker-compose.yml.example"
-
-CONTAINERS_DIR.mkdir(exist_ok=True)
+# named compose templates (one YAML file per image family)
+TEMPLATES_DIR = PROJECT_ROOT / "scripts" / "templates"
+DEFAULT_TEMPLATE = "default"
+# per-container metadata: template name and the override rendered on top of it
+CONTAINER_META = "vdesk.json"
 
 # Setup logs directory and rotating logger
-LOG_DIR = WEB_ROOT / "logs"
-LOG_DIR.mkdir(parents=True, exist_ok=True)
+LOG_DIR = Path(os.environ.get("VDESK_LOG_DIR", str(WEB_ROOT / "logs")))
 LOG_FILE = LOG_DIR / "commands.log"
 
-# configure rotating file handler (5MB per file, keep 7 backups)
-handler = RotatingFileHandler(str(LOG_FILE), maxBytes=5 * 1024 * 1024, backupCount=7)
-formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
-handler.setFormatter(formatter)
-
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-# avoid adding duplicate handlers if module reloaded
-if not any(isinstance(h, RotatingFileHandler) and h.baseFilename == str(LOG_FILE) for h in logger.handlers):
-    logger.addHandler(handler)
-# also log to console
-if not any(isinstance(h, logging.StreamHandler) for h in logger.handlers):
+# Logging pipeline: request handlers only enqueue records; a QueueListener
+# thread formats them and does the file/console I/O.
+# longest message kept per record (characters)
+LOG_MESSAGE_LIMIT = int(os.environ.get("VDESK_LOG_MESSAGE_LIMIT", "2000"))
+# records tagged with a `sample_key` are logged at most once per interval (seconds)
+LOG_SAMPLE_INTERVAL = float(os.environ.get("VDESK_LOG_SAMPLE_INTERVAL", "60"))
+LOG_QUEUE_SIZE = int(os.environ.get("VDESK_LOG_QUEUE_SIZE", "10000"))
+# commands.log format: json (one object per line) or text
+LOG_FORMAT = os.environ.get("VDESK_LOG_FORMAT", "json")
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + 'Z',
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in ("sample_key", "suppressed"):
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        # queued records carry the formatted traceback in exc_text (see CappedQueueHandler)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SampleFilter(logging.Filter):
+    """Pass one record per `sample_key` per interval and report how many were dropped."""
+
+    def __init__(self, interval: float):
+        super().__init__()
+        self.interval = interval
+        self._last: Dict[str, float] = {}
+        self._suppressed: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, "sample_key", None)
+        if key is None or self.interval <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last.get(key, float("-inf")) < self.interval:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return False
+            self._last[key] = now
+            record.suppressed = self._suppressed.pop(key, 0)
+        return True
+
+
+_traceback_formatter = logging.Formatter()
+
+
+class CappedQueueHandler(QueueHandler):
+    """QueueHandler that truncates long messages and drops records when the
+    queue is full instead of blocking the caller."""
+
+    def __init__(self, q, limit: int):
+        super().__init__(q)
+        self.limit = limit
+        self.dropped = 0
+
+    def prepare(self, record):
+        # like QueueHandler.prepare, but only the message is merged and capped;
+        # the traceback goes along in full as exc_text for the formatters
+        record = copy.copy(record)
+        msg = record.getMessage()
+        if len(msg) > self.limit:
+            msg = f"{msg[:self.limit]}... [{len(msg) - self.limit} chars truncated]"
+        if record.exc_info and not record.exc_text:
+            record.exc_text = _traceback_formatter.formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = msg, None, None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging():
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    # avoid adding duplicate handlers if module reloaded
+    for h in root.handlers:
+        if isinstance(h, CappedQueueHandler):
+            return h, None
+    text_formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
+    # configure rotating file handler (5MB per file, keep 7 backups)
+    file_handler = RotatingFileHandler(str(LOG_FILE), maxBytes=5 * 1024 * 1024, backupCount=7)
+    file_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else text_formatter)
+    # also log to console
     console = logging.StreamHandler()
-    console.setFormatter(formatter)
-    logger.addHandler(console)
+    console.setFormatter(text_formatter)
+    queue_handler = CappedQueueHandler(queue.Queue(LOG_QUEUE_SIZE), LOG_MESSAGE_LIMIT)
+    queue_handler.addFilter(SampleFilter(LOG_SAMPLE_INTERVAL))
+    listener = QueueListener(queue_handler.queue, file_handler, console, respect_handler_level=True)
+    listener.start()
+    root.addHandler(queue_handler)
+    return queue_handler, listener
+
+
+# set up by startup(), the listener is stopped on shutdown
+log_queue_handler: Optional[CappedQueueHandler] = None
+log_listener: Optional[QueueListener] = None
+
+# Audit log
+#
+# Structured record of every action (API operations and the docker commands
+# they run) in SQLite, queryable through /api/audit. commands.log keeps only
+# one-line summaries.
+AUDIT_DB = Path(os.environ.get("VDESK_AUDIT_DB", str(LOG_DIR / "audit.db")))
+# stdout/stderr kept per event (characters, head and tail)
+AUDIT_OUTPUT_LIMIT = int(os.environ.get("VDESK_AUDIT_OUTPUT_LIMIT", "4096"))
+AUDIT_RETENTION_DAYS = int(os.environ.get("VDESK_AUDIT_RETENTION_DAYS", "180"))
+
+# user performing the current request, set by auth_middleware
+current_user: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_user", default=None)
+
+_audit_lock = threading.Lock()
+
+
+def _open_audit_db(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts REAL NOT NULL,
+            user TEXT,
+            container TEXT,
+            action TEXT NOT NULL,
+            detail TEXT,
+            returncode INTEGER,
+            duration REAL,
+            stdout TEXT,
+            stderr TEXT,
+            extra TEXT
+        );
+        CREATE INDEX IF NOT EXISTS ix_events_ts ON events (ts);
+        CREATE INDEX IF NOT EXISTS ix_events_user_ts ON events (user, ts);
+        CREATE INDEX IF NOT EXISTS ix_events_container_ts ON events (container, ts);
+        CREATE INDEX IF NOT EXISTS ix_events_action_ts ON events (action, ts);
+    """)
+    if AUDIT_RETENTION_DAYS > 0:
+        conn.execute("DELETE FROM events WHERE ts < ?", (time.time() - AUDIT_RETENTION_DAYS * 86400,))
+    return conn
+
+
+def truncate_output(text: Optional[str], limit: int = AUDIT_OUTPUT_LIMIT) -> Optional[str]:
+    """Keep the head and tail of long command output."""
+    if not text or len(text) <= limit:
+        return text
+    half = limit // 2
+    return f"{text[:half]}\n... [{len(text) - 2 * half} chars truncated] ...\n{text[-half:]}"
+
+
+def audit(action: str, container: Optional[str] = None, detail: Optional[str] = None,
+          returncode: Optional[int] = None, duration: Optional[float] = None,
+          stdout: Optional[str] = None, stderr: Optional[str] = None,
+          user: Optional[str] = None, **extra):
+    """Record an event in the audit store. Never raises."""
+    if audit_db is None:
+        # not started (or already shut down)
+        return
+    try:
+        row = (time.time(), user or current_user.get(), container, action, detail, returncode,
+               round(duration, 3) if duration is not None else None,
+               truncate_output(stdout), truncate_output(stderr),
+               json.dumps(extra) if extra else None)
+        with _audit_lock:
+            audit_db.execute(
+                "INSERT INTO events (ts, user, container, action, detail, returncode, duration, stdout, stderr, extra)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+    except Exception:
+        logging.exception("failed to record audit event %s", action)
+
+
+def _audit_row(row: sqlite3.Row, with_output: bool) -> dict:
+    item = {
+        "id": row["id"],
+        "timestamp": datetime.utcfromtimestamp(row["ts"]).isoformat() + 'Z',
+        "user": row["user"],
+        "container": row["container"],
+        "action": row["action"],
+        "detail": row["detail"],
+        "returncode": row["returncode"],
+        "duration": row["duration"],
+        "extra": json.loads(row["extra"]) if row["extra"] else None,
+    }
+    if with_output:
+        item["stdout"] = row["stdout"]
+        item["stderr"] = row["stderr"]
+    return item
+
+
+# opened by startup()
+audit_db: Optional[sqlite3.Connection] = None
 
 # Models
 class ContainerCreate(BaseModel):
@@ -73,6 +389,7 @@ class ContainerCreate(BaseModel):
     swap: Optional[str] = None
     root_password: Optional[str] = None
     comment: Optional[str] = None
+    template: Optional[str] = None
 
 class ContainerModify(BaseModel):
     memory: Optional[str]
@@ -83,6 +400,8 @@ class ContainerModify(BaseModel):
     comment: Optional[str]
     cpus: Optional[int]
     realtime_update: Optional[bool] = None
+    # revision the client last saw; a stale value is rejected with 409
+    revision: Optional[int] = None
 
 class ContainerInfo(BaseModel):
     name: str
@@ -95,15 +414,160 @@ class ContainerInfo(BaseModel):
     swap: Optional[str] = None
     root_password: Optional[str] = None
     comment: Optional[str] = None
+    template: Optional[str] = None
+    revision: Optional[int] = None
     state: Optional[str] = None
+    # desktop port accepts connections (None until probed)
+    ready: Optional[bool] = None
 
 class ChangePasswordModel(BaseModel):
     old_password: str
     new_password: str
 
+class TemplateUpdate(BaseModel):
+    content: str = Field(..., description="compose template as YAML text")
+
 
 # Helpers
 
+# Per-container locks
+#
+# Operations that rewrite the compose file or recreate the container (create,
+# modify, start/stop/restart/delete, reconcile, template re-render) hold the
+# container's lock exclusively; exec holds it shared. The lock is a
+# readers-writer lock within this process plus an flock() on LOCK_DIR/<name>.lock
+# so several uvicorn workers exclude each other too. Different containers never
+# contend.
+LOCK_DIR = Path(os.environ.get("VDESK_LOCK_DIR", str(WEB_ROOT / "locks")))
+# seconds to wait for a busy container before answering 409
+LOCK_TIMEOUT = float(os.environ.get("VDESK_LOCK_TIMEOUT", "120"))
+
+
+class ContainerBusy(Exception):
+    pass
+
+
+class ContainerLock:
+    """Readers-writer lock for one container, shared across threads and processes."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._fd = None
+
+    def _flock(self, mode: int, deadline: float) -> bool:
+        if self._fd is None:
+            LOCK_DIR.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(str(LOCK_DIR / f"{self.name}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        while True:
+            try:
+                fcntl.flock(self._fd, mode | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(0.05)
+
+    def acquire(self, shared: bool = False, timeout: float = LOCK_TIMEOUT) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if shared:
+                ok = self._cond.wait_for(lambda: not self._writer, timeout)
+            else:
+                ok = self._cond.wait_for(lambda: not self._writer and self._readers == 0, timeout)
+            if not ok:
+                return False
+            # the first in-process holder takes the cross-process lock
+            first = self._readers == 0 if shared else True
+            if first and not self._flock(fcntl.LOCK_SH if shared else fcntl.LOCK_EX, deadline):
+                return False
+            if shared:
+                self._readers += 1
+            else:
+                self._writer = True
+        return True
+
+    def release(self, shared: bool = False):
+        with self._cond:
+            if shared:
+                self._readers -= 1
+                last = self._readers == 0
+            else:
+                self._writer = False
+                last = True
+            if last:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._cond.notify_all()
+
+
+_container_locks: Dict[str, ContainerLock] = {}
+_container_locks_guard = threading.Lock()
+
+
+def _get_lock(name: str) -> ContainerLock:
+    if not name or "/" in name or name in (".", ".."):
+        # the name becomes a file name in LOCK_DIR
+        raise HTTPException(status_code=400, detail="invalid container name")
+    with _container_locks_guard:
+        lock = _container_locks.get(name)
+        if lock is None:
+            lock = _container_locks[name] = ContainerLock(name)
+        return lock
+
+
+@contextmanager
+def container_lock(name: str, shared: bool = False, timeout: float = LOCK_TIMEOUT):
+    """Hold a container's lock; raises ContainerBusy after `timeout` seconds."""
+    lock = _get_lock(name)
+    if not lock.acquire(shared, timeout):
+        raise ContainerBusy(name)
+    try:
+        yield
+    finally:
+        lock.release(shared)
+
+
+@asynccontextmanager
+async def container_lock_async(name: str, shared: bool = False, timeout: float = LOCK_TIMEOUT):
+    """Async variant of container_lock; waits in a worker thread, not on the event loop."""
+    lock = _get_lock(name)
+    acquiring = asyncio.ensure_future(asyncio.to_thread(lock.acquire, shared, timeout))
+
+    def release_if_acquired(fut):
+        if not fut.cancelled() and fut.exception() is None and fut.result():
+            lock.release(shared)
+
+    try:
+        acquired = await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        # the worker thread can't be interrupted; if it still gets the lock,
+        # give it back as soon as it does
+        acquiring.add_done_callback(release_if_acquired)
+        raise
+    if not acquired:
+        raise ContainerBusy(name)
+    try:
+        yield
+    finally:
+        lock.release(shared)
+
+
+def atomic_write_text(path: Path, text: str):
+    """Write a file via a temp file in the same directory and rename, so readers
+    never see a truncated or half-written file."""
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with tmp.open("w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
 def load_compose(path: Path):
     try:
         with path.open() as f:
@@ -130,28 +594,26 @@ def save_compose(path: Path, data, comment: Optional[str] = None):
                         comment_line = first
             except Exception:
                 comment_line = None
-    with path.open("w") as f:
-        if comment_line:
-            f.write(comment_line)
-        yaml.safe_dump(data, f, sort_keys=False)
+    atomic_write_text(path, (comment_line or "") + yaml.safe_dump(data, sort_keys=False))
+    # every compose write bumps the container's revision (optimistic concurrency)
+    state = read_container_state(path.parent)
+    update_container_state(path.parent, revision=state.get("revision", 0) + 1)
 
 
 def run_compose(compose_path: Path, args: List[str]):
     cmd = ["docker", "compose", "-f", str(compose_path)] + args
+    container = compose_path.parent.name
+    start = time.monotonic()
     try:
         proc = subprocess.run(cmd, capture_output=True, text=True, check=False)
-        # Log command output to the log file
-        try:
-            logging.info("CMD: %s RETURN: %s", ' '.join(cmd), proc.returncode)
-            if proc.stdout:
-                logging.info("STDOUT: %s", proc.stdout)
-            if proc.stderr:
-                logging.info("STDERR: %s", proc.stderr)
-        except Exception:
-            pass
+        duration = time.monotonic() - start
+        # full output goes to the audit store, the log file keeps a summary
+        logging.info("CMD: %s RETURN: %s (%.2fs)", ' '.join(cmd), proc.returncode, duration)
+        audit("compose", container, ' '.join(args), proc.returncode, duration, proc.stdout, proc.stderr)
         return {"returncode": proc.returncode, "stdout": proc.stdout, "stderr": proc.stderr}
     except FileNotFoundError as e:
         logging.error("CMD FAILED: %s ERROR: %s", ' '.join(cmd), str(e))
+        audit("compose", container, ' '.join(args), 127, time.monotonic() - start, stderr=str(e))
         return {"returncode": 127, "stdout": "", "stderr": str(e)}
 
 
@@ -210,15 +672,8 @@ def _docker_ps_map():
     """Return a list of tuples (name, status) from `docker ps -a`."""
     try:
         proc = subprocess.run(["docker", "ps", "-a", "--format", "{{.Names}}|||{{.Status}}"], capture_output=True, text=True, check=False)
-        # log output
-        try:
-            logging.info("CMD: docker ps -a --format '{{.Names}}|||{{.Status}}' RETURN: %s", proc.returncode)
-            if proc.stdout:
-                logging.info("STDOUT: %s", proc.stdout)
-            if proc.stderr:
-                logging.info("STDERR: %s", proc.stderr)
-        except Exception:
-            pass
+        logging.info("CMD: docker ps -a --format '{{.Names}}|||{{.Status}}' RETURN: %s", proc.returncode,
+                     extra={"sample_key": "docker_ps"})
         out = proc.stdout or ""
     except FileNotFoundError:
         logging.error("docker command not found when running docker ps -a")
@@ -254,6 +709,508 @@ def compute_host_port_from_name(name: str) -> int:
         raise ValueError("computed port out of range")
     return port
 
+
+# Compose templates
+#
+# Templates are parsed and validated once, then kept as frozen base documents.
+# A container directory stores only its template name and an override
+# (`vdesk.json`); docker-compose.yml is rendered from base + override.
+
+def _freeze(obj):
+    """Return a read-only deep copy of a parsed YAML document."""
+    if isinstance(obj, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple(_freeze(v) for v in obj)
+    return obj
+
+
+def _thaw(obj):
+    """Return a mutable deep copy of a (possibly frozen) document."""
+    if isinstance(obj, (dict, MappingProxyType)):
+        return {k: _thaw(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_thaw(v) for v in obj]
+    return obj
+
+
+def deep_merge(base, override):
+    """Merge override on top of base and return a new document.
+    Mappings merge recursively, a None value removes the key, lists and scalars
+    replace. A mapping applied to a list is treated as KEY=VALUE updates of a
+    compose `environment` list.
+    """
+    if isinstance(override, dict) and isinstance(base, (dict, MappingProxyType)):
+        merged = {}
+        # keep the template's key order, new keys go last
+        for k, v in base.items():
+            if k not in override:
+                merged[k] = _thaw(v)
+            elif override[k] is not None:
+                merged[k] = deep_merge(v, override[k])
+        for k, v in override.items():
+            if k not in base and v is not None:
+                merged[k] = _thaw(v)
+        return merged
+    if isinstance(override, dict) and isinstance(base, (list, tuple)):
+        env = _thaw(base)
+        for k, v in override.items():
+            if v is None:
+                env = [e for e in env if not (isinstance(e, str) and e.split("=", 1)[0] == k)]
+            else:
+                set_env_key_in_list(env, k, v)
+        return env
+    return _thaw(override)
+
+
+def _container_port_from_service(svc) -> Optional[str]:
+    """Return the container-side port of the first `ports` entry of a service."""
+    ports_def = svc.get("ports")
+    if not ports_def or not isinstance(ports_def, (list, tuple)):
+        return None
+    first = ports_def[0]
+    # support short string 'HOST:CONTAINER' or 'HOST:CONTAINER/proto'
+    if isinstance(first, (str, int)):
+        try:
+            right = str(first).split(":", 1)[1]
+            return right.split("/")[0] or None
+        except Exception:
+            return None
+    if isinstance(first, (dict, MappingProxyType)):
+        # long syntax: { published: 14000, target: 4000 }
+        port = str(first.get("target") or first.get("container") or first.get("to") or "")
+        return port or None
+    return None
+
+
+def parse_template(name: str, text: str) -> dict:
+    """Parse and validate template YAML text. Raises ValueError when invalid."""
+    try:
+        data = yaml.safe_load(text)
+    except yaml.YAMLError as e:
+        raise ValueError(f"template {name}: invalid YAML: {e}")
+    if not isinstance(data, dict):
+        raise ValueError(f"template {name}: top level must be a mapping")
+    svc = (data.get("services") or {}).get("my_ws")
+    if not isinstance(svc, dict):
+        raise ValueError(f"template {name}: services.my_ws is required")
+    if not svc.get("image"):
+        raise ValueError(f"template {name}: services.my_ws.image is required")
+    env = svc.get("environment")
+    if env is not None and not isinstance(env, (dict, list)):
+        raise ValueError(f"template {name}: environment must be a mapping or a list")
+    meta = data.pop("x-vdesk", None) or {}
+    if not isinstance(meta, dict):
+        raise ValueError(f"template {name}: x-vdesk must be a mapping")
+    return {
+        "name": name,
+        "description": meta.get("description") or "",
+        "images": [str(p) for p in (meta.get("images") or [])],
+        # fallback default container port
+        "container_port": _container_port_from_service(svc) or "22",
+        "digest": hashlib.sha1(text.encode()).hexdigest(),
+        "path": None,
+        "base": _freeze(data),
+    }
+
+
+def _template_files() -> Dict[str, Path]:
+    files = {}
+    if TEMPLATE_COMPOSE.exists():
+        files[DEFAULT_TEMPLATE] = TEMPLATE_COMPOSE
+    if TEMPLATES_DIR.is_dir():
+        for p in sorted(TEMPLATES_DIR.glob("*.yml")):
+            files[p.stem] = p
+    return files
+
+
+def load_templates() -> Dict[str, dict]:
+    """Parse all templates from disk. Invalid templates are logged and skipped."""
+    templates = {}
+    for name, path in _template_files().items():
+        try:
+            tpl = parse_template(name, path.read_text())
+        except (OSError, ValueError) as e:
+            logging.error("failed to load compose template %s: %s", path, e)
+            continue
+        tpl["path"] = path
+        templates[name] = tpl
+    logging.info("loaded compose templates: %s", ", ".join(templates) or "(none)")
+    return templates
+
+
+def select_template(image: str, requested: Optional[str] = None) -> dict:
+    """Pick the template for an image: the requested one, the template with
+    the longest `images` pattern occurring in the image name (the most
+    specific match; ties go to the first template by name), or the default
+    template.
+    """
+    if requested:
+        tpl = TEMPLATES.get(requested)
+        if tpl is None:
+            raise KeyError(requested)
+        return tpl
+    best, best_len = None, 0
+    for name, tpl in TEMPLATES.items():
+        if name == DEFAULT_TEMPLATE:
+            continue
+        matched = max((len(p) for p in tpl["images"] if p and p in image), default=0)
+        if matched > best_len:
+            best, best_len = tpl, matched
+    if best is not None:
+        return best
+    if DEFAULT_TEMPLATE in TEMPLATES:
+        return TEMPLATES[DEFAULT_TEMPLATE]
+    raise KeyError(DEFAULT_TEMPLATE)
+
+
+def read_container_state(path: Path) -> dict:
+    """Return the raw contents of a container's `vdesk.json` ({} if missing)."""
+    meta_file = path / CONTAINER_META
+    if not meta_file.exists():
+        return {}
+    try:
+        with meta_file.open() as f:
+            state = json.load(f)
+    except Exception:
+        logging.exception("failed to read %s", meta_file)
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def update_container_state(path: Path, **fields):
+    """Set top-level fields of a container's `vdesk.json`, keeping the others."""
+    state = read_container_state(path)
+    state.update(fields)
+    save_container_meta(path, state)
+
+
+def load_container_meta(path: Path) -> Optional[dict]:
+    """Return the template metadata of a container dir, None for legacy dirs
+    whose compose file is edited directly."""
+    meta = read_container_state(path)
+    if not meta.get("template"):
+        return None
+    meta.setdefault("override", {})
+    return meta
+
+
+def save_container_meta(path: Path, meta: dict):
+    atomic_write_text(path / CONTAINER_META, json.dumps(meta, indent=2))
+
+
+def compose_digest(compose_path: Path) -> Optional[str]:
+    try:
+        return hashlib.sha1(compose_path.read_bytes()).hexdigest()
+    except OSError:
+        return None
+
+
+def mark_desired(path: Path, running: bool, res: Optional[dict] = None):
+    """Record the desired-running flag of a container. When `res` is the result of
+    a successful `up`, also record the digest of the compose file that was applied.
+    """
+    fields = {"desired_running": running}
+    if res is not None and res.get("returncode") == 0:
+        fields["applied_digest"] = compose_digest(path / "docker-compose.yml")
+    try:
+        update_container_state(path, **fields)
+    except Exception:
+        logging.exception("failed to record desired state for %s", path.name)
+
+
+def render_container(path: Path, meta: dict, comment: Optional[str] = None):
+    """Render docker-compose.yml of a container from its template and override."""
+    tpl = TEMPLATES.get(meta["template"])
+    if tpl is None:
+        raise KeyError(meta["template"])
+    data = deep_merge(tpl["base"], meta.get("override") or {})
+    save_compose(path / "docker-compose.yml", data, comment)
+    return data
+
+
+def rerender_template(name: str) -> List[str]:
+    """Re-render the compose files of all containers using template `name`."""
+    rendered = []
+    if not CONTAINERS_DIR.exists():
+        return rendered
+    for p in sorted(CONTAINERS_DIR.iterdir()):
+        if not p.is_dir():
+            continue
+        meta = load_container_meta(p)
+        if meta is None or meta["template"] != name:
+            continue
+        try:
+            with container_lock(p.name):
+                # re-read under the lock, a modify may have just changed it
+                meta = load_container_meta(p)
+                render_container(p, meta)
+            rendered.append(p.name)
+        except Exception:
+            logging.exception("failed to re-render %s from template %s", p.name, name)
+    logging.info("re-rendered %d container(s) from template %s", len(rendered), name)
+    if rendered:
+        notify_changed(*rendered)
+    return rendered
+
+
+def _template_summary(tpl: dict) -> dict:
+    return {
+        "name": tpl["name"],
+        "description": tpl["description"],
+        "images": tpl["images"],
+        "container_port": tpl["container_port"],
+        "digest": tpl["digest"],
+    }
+
+
+# loaded by startup()
+TEMPLATES: Dict[str, dict] = {}
+
+# Container list cache and change feed
+#
+# The container list is built from the compose dirs plus one `docker ps -a`
+# and cached with a version number. API mutations refresh just the affected
+# container; the full list is rebuilt when older than FLEET_CACHE_TTL. Every
+# difference found bumps the version and is pushed to /api/containers/feed.
+# Versions only count within one process, so ETags and feed messages also
+# carry FLEET_EPOCH; a client coming back from another process (a restart or
+# another worker) gets a snapshot instead of a replay.
+
+# seconds a cached docker state may be served before the list is rebuilt
+FLEET_CACHE_TTL = float(os.environ.get("VDESK_FLEET_CACHE_TTL", "5"))
+FLEET_FEED_BACKLOG = 512
+FLEET_FEED_QUEUE = 1000
+
+_fleet_lock = threading.Lock()
+_fleet_build_lock = threading.Lock()
+_fleet = {"version": 0, "items": {}, "built": None}
+FLEET_EPOCH = uuid.uuid4().hex[:12]
+# the serialized list of one fleet version and its compressed variants
+_fleet_payload = {"version": None, "body": b"[]", "encoded": {}}
+_feed_backlog = deque(maxlen=FLEET_FEED_BACKLOG)
+_feed_subscribers = set()
+_event_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _state_from_ps(name: str, ps_entries) -> str:
+    # determine state from `docker ps -a` STATUS field
+    for cname, cstatus in ps_entries:
+        if name in cname:
+            return cstatus
+    return "idle"
+
+
+def build_container_info(p: Path, ps_entries) -> Optional[dict]:
+    """Return the list entry of a container dir, None if it is not a valid container."""
+    if not p.is_dir():
+        return None
+    compose_path = p / "docker-compose.yml"
+    if not compose_path.exists():
+        return None
+    data = load_compose(compose_path)
+    if data is None:
+        return None
+    info = parse_compose_info(data)
+    info.name = p.name
+    meta = load_container_meta(p)
+    if meta is not None:
+        info.template = meta["template"]
+    info.revision = read_container_state(p).get("revision", 0)
+    # read optional top comment line from compose file
+    try:
+        with compose_path.open() as f:
+            first = f.readline().strip()
+            if first.startswith("# comment:"):
+                info.comment = first[len("# comment:"):].strip()
+    except Exception:
+        pass
+    info.state = _state_from_ps(p.name, ps_entries)
+    info.ready = _readiness.get(p.name, {}).get("ready")
+    return jsonable_encoder(info)
+
+
+def _publish(event: dict):
+    """Queue an event for every feed subscriber (callable from any thread)."""
+    _feed_backlog.append(event)
+    loop = _event_loop
+    if loop is None or loop.is_closed():
+        return
+    for q in list(_feed_subscribers):
+        loop.call_soon_threadsafe(_offer, q, event)
+
+
+def _offer(q: asyncio.Queue, event: dict):
+    try:
+        q.put_nowait(event)
+    except asyncio.QueueFull:
+        # slow consumer: drop what it has queued and make it resync from a snapshot
+        while not q.empty():
+            q.get_nowait()
+        q.put_nowait({"type": "resync"})
+
+
+def refresh_fleet(names: Optional[List[str]] = None) -> int:
+    """Rebuild the cached entries of `names` (all containers if None) and
+    publish a delta for each entry that changed. Returns the fleet version."""
+    ps_entries = _docker_ps_map()
+    if names is None:
+        dirs = sorted(CONTAINERS_DIR.iterdir()) if CONTAINERS_DIR.exists() else []
+        fresh = {}
+        for p in dirs:
+            item = build_container_info(p, ps_entries)
+            if item is not None:
+                fresh[p.name] = item
+    else:
+        fresh = {n: build_container_info(CONTAINERS_DIR / n, ps_entries) for n in names}
+    with _fleet_lock:
+        items = dict(_fleet["items"])
+        candidates = set(fresh) | (set(items) if names is None else set())
+        for name in sorted(candidates):
+            old, new = items.get(name), fresh.get(name)
+            if old == new:
+                continue
+            if old is None:
+                kind = "create"
+            elif new is None:
+                kind = "delete"
+            elif {**old, "state": None, "ready": None} == {**new, "state": None, "ready": None}:
+                kind = "state"
+            else:
+                kind = "modify"
+            if new is None:
+                items.pop(name, None)
+            else:
+                items[name] = new
+            _fleet["version"] += 1
+            _publish({"type": "delta", "event": kind, "version": _fleet["version"], "name": name, "item": new})
+        _fleet["items"] = items
+        if names is None:
+            _fleet["built"] = time.monotonic()
+        return _fleet["version"]
+
+
+def get_fleet():
+    """Return (version, sorted list of container entries), rebuilding when stale."""
+    built = _fleet["built"]
+    if built is None or time.monotonic() - built > FLEET_CACHE_TTL:
+        with _fleet_build_lock:
+            # another request may have rebuilt it while we waited
+            built = _fleet["built"]
+            if built is None or time.monotonic() - built > FLEET_CACHE_TTL:
+                refresh_fleet()
+    with _fleet_lock:
+        items = _fleet["items"]
+        return _fleet["version"], [items[k] for k in sorted(items)]
+
+
+def get_fleet_payload():
+    """Return (version, serialized list, encoding -> compressed list) for the
+    current fleet version; the list is serialized once per version."""
+    version, items = get_fleet()
+    with _fleet_lock:
+        if _fleet_payload["version"] != version:
+            _fleet_payload.update(version=version, body=json_bytes(items), encoded={})
+        return version, _fleet_payload["body"], _fleet_payload["encoded"]
+
+
+def notify_changed(*names: str):
+    """Refresh the list entries of containers changed by an API call. Never raises."""
+    try:
+        refresh_fleet(list(names))
+    except Exception:
+        logging.exception("failed to refresh container list for %s", ", ".join(names))
+
+
+# Readiness probes
+#
+# A container is ready when its published desktop port accepts TCP connections,
+# which is what users actually need (the container can be "Up" long before
+# NoMachine listens). A background task probes every running container
+# concurrently; results are cached and shown as `ready` in the list.
+PROBE_HOST = os.environ.get("VDESK_PROBE_HOST", "127.0.0.1")
+# seconds between probe passes, 0 disables the background prober
+PROBE_INTERVAL = float(os.environ.get("VDESK_PROBE_INTERVAL", "10"))
+PROBE_TIMEOUT = float(os.environ.get("VDESK_PROBE_TIMEOUT", "1"))
+PROBE_CONCURRENCY = int(os.environ.get("VDESK_PROBE_CONCURRENCY", "64"))
+# seconds create waits for the new desktop to become ready, 0 skips the wait
+READY_TIMEOUT = float(os.environ.get("VDESK_READY_TIMEOUT", "60"))
+_readiness: Dict[str, dict] = {}
+
+
+def desktop_port(name: str, port: Optional[int] = None) -> Optional[int]:
+    """Published desktop port of a container: the compose mapping if known, else derived from the name."""
+    if port:
+        return int(port)
+    try:
+        return compute_host_port_from_name(name)
+    except ValueError:
+        return None
+
+
+def set_ready(name: str, ready: bool):
+    """Record a probe result and publish a list delta if readiness changed."""
+    prev = _readiness.get(name)
+    _readiness[name] = {"ready": ready, "checked": time.time()}
+    if prev is not None and prev["ready"] == ready:
+        return
+    with _fleet_lock:
+        item = _fleet["items"].get(name)
+        if item is None or item.get("ready") == ready:
+            return
+        items = dict(_fleet["items"])
+        items[name] = {**item, "ready": ready}
+        _fleet["version"] += 1
+        _publish({"type": "delta", "event": "state", "version": _fleet["version"], "name": name, "item": items[name]})
+        _fleet["items"] = items
+
+
+async def probe_port(port: int, timeout: float = PROBE_TIMEOUT) -> bool:
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(PROBE_HOST, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+async def probe_fleet():
+    """Probe every running container in the cached list once, concurrently."""
+    with _fleet_lock:
+        items = list(_fleet["items"].values())
+    sem = asyncio.Semaphore(max(1, PROBE_CONCURRENCY))
+
+    async def probe(item):
+        port = desktop_port(item["name"], item.get("port"))
+        if port is None or not str(item.get("state") or "").startswith("Up"):
+            set_ready(item["name"], False)
+            return
+        async with sem:
+            set_ready(item["name"], await probe_port(port))
+
+    await asyncio.gather(*(probe(i) for i in items))
+    for name in set(_readiness) - {i["name"] for i in items}:
+        _readiness.pop(name, None)
+
+
+def wait_ready(port: int, timeout: float = READY_TIMEOUT) -> bool:
+    """Block until the port accepts TCP connections or `timeout` passes."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection((PROBE_HOST, port), timeout=PROBE_TIMEOUT):
+                return True
+        except OSError:
+            pass
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.5)
+
+
 def get_host_resources():
     """Return host resources: cpu count, total memory in bytes, gpus list of dicts {id,name}."""
     # CPUs
@@ -309,6 +1266,187 @@ def get_host_resources():
     return {'cpus': cpus, 'memory_bytes': mem_bytes, 'gpus': gpus}
 
 
+# NUMA placement
+#
+# New desktops get a `cpuset` of otherwise unassigned cores, taken from the
+# NUMA nodes their GPUs are attached to (then the nodes with most free cores),
+# so GPU-heavy desktops don't run their threads on the far socket. Topology
+# comes from sysfs (VDESK_SYSFS_ROOT points it at a fake tree for testing);
+# assignments are the `cpuset`s in the existing compose files. When not enough
+# free cores are left the desktop is not pinned, as before. Compose has no
+# cpuset-mems setting, so memory stays local through first-touch allocation
+# on the pinned cores; the chosen nodes are recorded in vdesk.json.
+SYSFS_ROOT = Path(os.environ.get("VDESK_SYSFS_ROOT", "/sys"))
+PLACEMENT_ENABLED = os.environ.get("VDESK_PLACEMENT", "1") == "1"
+NVIDIA_PCI_VENDOR = "0x10de"
+
+
+def parse_cpulist(text: str) -> List[int]:
+    """Parse a kernel cpulist such as "0-3,8,10-11"."""
+    cpus = []
+    for part in (text or "").strip().split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+    return sorted(set(cpus))
+
+
+def format_cpulist(cpus) -> str:
+    """Format cpu ids as a compact cpulist ("0-3,8")."""
+    out = []
+    for c in sorted(set(cpus)):
+        if out and c == out[-1][1] + 1:
+            out[-1][1] = c
+        else:
+            out.append([c, c])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in out)
+
+
+def read_numa_topology(root: Path = None) -> Dict[int, List[int]]:
+    """Return NUMA node -> cpu ids. Hosts without node info are one node 0."""
+    root = root or SYSFS_ROOT
+    nodes = {}
+    node_dir = root / "devices" / "system" / "node"
+    for d in sorted(node_dir.glob("node[0-9]*")) if node_dir.is_dir() else []:
+        try:
+            cpus = parse_cpulist((d / "cpulist").read_text())
+        except (OSError, ValueError):
+            continue
+        if cpus:
+            nodes[int(d.name[4:])] = cpus
+    if not nodes:
+        try:
+            cpus = parse_cpulist((root / "devices" / "system" / "cpu" / "online").read_text())
+        except (OSError, ValueError):
+            cpus = list(range(os.cpu_count() or 1))
+        nodes[0] = cpus
+    return nodes
+
+
+def read_gpu_numa_nodes(root: Path = None) -> Dict[int, Optional[int]]:
+    """Return GPU index -> NUMA node (None if unknown). NVIDIA display/3D
+    controllers are numbered in PCI address order, as nvidia-smi does."""
+    root = root or SYSFS_ROOT
+    devices = root / "bus" / "pci" / "devices"
+    gpus = []
+    for d in sorted(devices.iterdir()) if devices.is_dir() else []:
+        try:
+            vendor = (d / "vendor").read_text().strip()
+            pci_class = (d / "class").read_text().strip()
+        except OSError:
+            continue
+        # 0x0300xx VGA controller, 0x0302xx 3D controller
+        if vendor == NVIDIA_PCI_VENDOR and pci_class[:6] in ("0x0300", "0x0302"):
+            try:
+                node = int((d / "numa_node").read_text().strip())
+            except (OSError, ValueError):
+                node = -1
+            gpus.append(node if node >= 0 else None)
+    return dict(enumerate(gpus))
+
+
+def assigned_cpusets(exclude: Optional[str] = None) -> Dict[str, List[int]]:
+    """Return container name -> pinned cpu ids from the existing compose files."""
+    assigned = {}
+    if not CONTAINERS_DIR.exists():
+        return assigned
+    for p in CONTAINERS_DIR.iterdir():
+        if p.name == exclude or not (p / "docker-compose.yml").exists():
+            continue
+        data = load_compose(p / "docker-compose.yml") or {}
+        cpuset = ((data.get("services") or {}).get("my_ws") or {}).get("cpuset")
+        if cpuset:
+            try:
+                assigned[p.name] = parse_cpulist(str(cpuset))
+            except ValueError:
+                logging.warning("ignoring invalid cpuset %r of %s", cpuset, p.name)
+    return assigned
+
+
+def plan_placement(cpus: int, gpus: List[int], nodes: Dict[int, List[int]],
+                   gpu_nodes: Dict[int, Optional[int]], used: set) -> Optional[dict]:
+    """Choose `cpus` free cores, preferring the NUMA nodes of `gpus`, then
+    keeping the desktop on as few nodes as possible. None if they don't fit."""
+    free = {n: [c for c in cs if c not in used] for n, cs in nodes.items()}
+    if cpus <= 0 or sum(len(cs) for cs in free.values()) < cpus:
+        return None
+    gpu_pref = [gpu_nodes.get(int(g)) for g in gpus]
+    local = [n for n in dict.fromkeys(gpu_pref) if n is not None and n in free]
+    local.sort(key=lambda n: -gpu_pref.count(n))
+    # a single node that fits everything beats spreading: GPU-local first, then the fullest fit
+    fits = [n for n in local if len(free[n]) >= cpus]
+    if not fits:
+        fits = sorted((n for n in free if n not in local and len(free[n]) >= cpus), key=lambda n: len(free[n]))
+    if fits:
+        order = [fits[0]]
+    else:
+        order = local + sorted((n for n in free if n not in local), key=lambda n: -len(free[n]))
+    chosen = []
+    for n in order:
+        chosen.extend(free[n][:cpus - len(chosen)])
+        if len(chosen) == cpus:
+            break
+    mems = sorted({n for n, cs in nodes.items() if set(cs) & set(chosen)})
+    return {"cpuset": format_cpulist(chosen), "mems": format_cpulist(mems),
+            "gpu_local": bool(local) and set(mems) <= set(local)}
+
+
+@contextmanager
+def placement_lock(timeout: float = LOCK_TIMEOUT):
+    """Held from choosing a cpuset until it is written, so concurrent creates
+    don't overlap. An flock in LOCK_DIR, so it also covers other workers."""
+    LOCK_DIR.mkdir(parents=True, exist_ok=True)
+    fd = os.open(str(LOCK_DIR / "placement.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise ContainerBusy("placement")
+                time.sleep(0.05)
+        yield
+    finally:
+        # closing the descriptor releases the flock
+        os.close(fd)
+
+
+def place_container(name: str, cpus: int, gpus: List[int]) -> Optional[dict]:
+    """Pick a cpuset for a container; the caller holds placement_lock() until it is saved."""
+    if not PLACEMENT_ENABLED:
+        return None
+    used = set()
+    for cs in assigned_cpusets(exclude=name).values():
+        used.update(cs)
+    placement = plan_placement(cpus, gpus or [], read_numa_topology(), read_gpu_numa_nodes(), used)
+    if placement is None:
+        logging.warning("no %s free cpus for %s, leaving it unpinned", cpus, name)
+    else:
+        logging.info("placed %s on cpus %s (numa nodes %s)", name, placement["cpuset"], placement["mems"])
+    return placement
+
+
+@app.get('/api/placement')
+def get_placement():
+    """Host NUMA topology, GPU affinity and the cpusets assigned to containers."""
+    nodes = read_numa_topology()
+    assigned = assigned_cpusets()
+    used = set(c for cs in assigned.values() for c in cs)
+    return {
+        "nodes": [{"node": n, "cpus": format_cpulist(cs), "free": format_cpulist(c for c in cs if c not in used)}
+                  for n, cs in sorted(nodes.items())],
+        "gpus": [{"id": g, "node": n} for g, n in sorted(read_gpu_numa_nodes().items())],
+        "containers": {name: format_cpulist(cs) for name, cs in sorted(assigned.items())},
+    }
+
+
 @app.get('/api/host')
 def host_info():
     """Return host resource information."""
@@ -332,11 +1470,92 @@ def list_images():
         f"{registry_url}ros2-humble-cu12.4.1-nomachine-priviledged:1.0",
     ]
 
+
+@app.get("/api/templates")
+def list_templates():
+    """Return the loaded compose templates."""
+    return [_template_summary(t) for t in TEMPLATES.values()]
+
+
+@app.get("/api/templates/{name}")
+def get_template(name: str):
+    """Return one compose template including its base document."""
+    tpl = TEMPLATES.get(name)
+    if tpl is None:
+        raise HTTPException(status_code=404, detail="template not found")
+    return {**_template_summary(tpl), "content": _thaw(tpl["base"])}
+
+
+@app.put("/api/templates/{name}")
+def update_template(name: str, payload: TemplateUpdate):
+    """Create or replace a compose template and re-render every container using it."""
+    global TEMPLATES
+    if not name.replace("-", "").replace("_", "").isalnum():
+        raise HTTPException(status_code=400, detail="invalid template name")
+    try:
+        tpl = parse_template(name, payload.content)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    existing = TEMPLATES.get(name)
+    path = existing["path"] if existing else TEMPLATES_DIR / f"{name}.yml"
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(payload.content)
+    except OSError as e:
+        logging.exception("failed to write template %s", path)
+        raise HTTPException(status_code=500, detail=str(e))
+    tpl["path"] = path
+    TEMPLATES = {**TEMPLATES, name: tpl}
+    rendered = rerender_template(name)
+    audit("template_update", detail=name, rendered=rendered)
+    return {"template": _template_summary(tpl), "rendered": rendered}
+
+
+@app.post("/api/templates/reload")
+def reload_templates():
+    """Re-read templates from disk and re-render containers whose template changed."""
+    global TEMPLATES
+    old = TEMPLATES
+    TEMPLATES = load_templates()
+    changed = [n for n, t in TEMPLATES.items() if n not in old or old[n]["digest"] != t["digest"]]
+    rendered = {n: rerender_template(n) for n in changed}
+    return {"templates": [_template_summary(t) for t in TEMPLATES.values()], "rendered": rendered}
+
 @app.post("/api/containers")
 def create_container(payload: ContainerCreate):
-    # validate name
+    # validate name before it becomes a lock file name
     if not (payload.name.isdigit() and len(payload.name) == 6):
         raise HTTPException(status_code=400, detail="name must be 6 digits")
+    with container_lock(payload.name):
+        created = _create_container(payload)
+    res, host_port = created.pop("compose_result"), created.pop("host_port")
+    # wait without the lock: execs, actions and modify on the new container
+    # shouldn't stall behind a desktop that takes a while (or never) to listen
+    ready = None
+    if res["returncode"] == 0 and READY_TIMEOUT > 0:
+        wait_start = time.monotonic()
+        ready = wait_ready(host_port, READY_TIMEOUT)
+        set_ready(payload.name, ready)
+        if ready:
+            logging.info("Container %s ready on port %s after %.1fs", payload.name, host_port, time.monotonic() - wait_start)
+        else:
+            logging.warning("Container %s not ready on port %s within %ss, applying patches anyway",
+                            payload.name, host_port, READY_TIMEOUT)
+    with container_lock(payload.name):
+        if (CONTAINERS_DIR / payload.name).exists():
+            try:
+                patch_result = apply_patches(payload.name, f"{payload.name}-my_ws-1")
+            except Exception as e:
+                logging.exception("error applying patches: %s", e)
+                patch_result = {"returncode": 1, "stdout": "", "stderr": str(e)}
+        else:
+            patch_result = {"returncode": 1, "stdout": "", "stderr": "container was deleted"}
+    return {"compose_result": res, "patch_result": patch_result, **created, "ready": ready}
+
+
+def _create_container(payload: ContainerCreate):
+    """Render and start a new container; readiness and patches follow in
+    create_container, outside the container lock."""
     # compute host port from name per README rules
     try:
         host_port = compute_host_port_from_name(payload.name)
@@ -345,171 +1564,101 @@ def create_container(payload: ContainerCreate):
     dest = CONTAINERS_DIR / payload.name
     if dest.exists():
         raise HTTPException(status_code=400, detail="container already exists")
-    if not TEMPLATE_COMPOSE.exists():
-        raise HTTPException(status_code=500, detail=str(TEMPLATE_COMPOSE) + " not found")
-    dest.mkdir(parents=True)
-    compose_path = dest / "docker-compose.yml"
-    shutil.copy2(TEMPLATE_COMPOSE, compose_path)
+    try:
+        tpl = select_template(payload.image, payload.template)
+    except KeyError as e:
+        raise HTTPException(status_code=400 if payload.template else 500, detail=f"compose template {e} not found")
 
-    data = load_compose(compose_path)
-    if data is None:
-        raise HTTPException(status_code=500, detail="failed to load compose template")
+    # generate a strong random root password if not provided
+    if payload.root_password:
+        root_pw = payload.root_password
+    else:
+        # generate a URL-safe password of approximately 14-15 characters
+        root_pw = secrets.token_urlsafe(11)
 
-    svc = data.setdefault("services", {}).setdefault("my_ws", {})
-    # set image
-    svc["image"] = payload.image
-    # determine container-side port from template if present
-    container_port = None
-    ports_def = svc.get("ports")
-    if ports_def and isinstance(ports_def, list) and len(ports_def) > 0:
-        first = ports_def[0]
-        # support short string 'HOST:CONTAINER' or 'HOST:CONTAINER/proto'
-        if isinstance(first, str):
-            try:
-                right = first.split(":", 1)[1]
-                container_port = right.split("/")[0]
-            except Exception:
-                container_port = None
-        elif isinstance(first, dict):
-            # long syntax: { published: 14000, target: 4000 }
-            container_port = str(first.get("target") or first.get("container") or first.get("to") or "")
-            if container_port == "":
-                container_port = None
-    # fallback default container port
-    if not container_port:
-        container_port = "22"
-    # set ports mapping using computed host port -> template container port
-    svc["ports"] = [f"{host_port}:{container_port}"]
-    # set shared memory size if provided
+    # the override holds only what differs per container; the template supplies the rest
+    svc = {
+        "image": payload.image,
+        # computed host port -> template container port
+        "ports": [f"{host_port}:{tpl['container_port']}"],
+        "deploy": {"resources": {"limits": {"memory": payload.memory, "cpus": str(payload.cpus)}}},
+        "environment": {"ROOTPASSWORD": root_pw},
+    }
     if payload.shm_size:
         svc["shm_size"] = payload.shm_size
-    # ensure deploy/resources structure
-    deploy = svc.setdefault("deploy", {})
-    resources = deploy.setdefault("resources", {})
-    limits = resources.setdefault("limits", {})
-    limits["memory"] = payload.memory
-    limits["cpus"] = str(payload.cpus)
-    reservations = resources.setdefault("reservations", {})
-    # devices list
     if payload.gpus:
         # store devices in the full expected structure for docker-compose
-        reservations["devices"] = [{
+        svc["deploy"]["resources"]["reservations"] = {"devices": [{
             "driver": "nvidia",
             "device_ids": [str(x) for x in payload.gpus],
             "capabilities": ["gpu"],
-        }]
-    # environment
-    # support both dict and list formats for environment in the compose template
-    env = svc.get("environment")
-    # generate a strong random root password if not provided
-    if payload.root_password:
-        root_pw = payload.root_password
-    else:
-        # generate a URL-safe password of approximately 14-15 characters
-        root_pw = secrets.token_urlsafe(11)
-
-    # use the module-level helper `set_env_key_in_list` (defined earlier)
-
-    if isinstance(env, list):
-        set_env_key_in_list(env, "ROOTPASSWORD", root_pw)
-        if payload.swap:
-            set_env_key_in_list(env, "SWAP_SIZE", payload.swap)
-    elif isinstance(env, dict):
-        env["ROOTPASSWORD"] = root_pw
-        if payload.swap:
-            env["SWAP_SIZE"] = payload.swap
-    else:
-        # not present or unexpected type: create dict
-        new_env = {"ROOTPASSWORD": root_pw}
-        if payload.swap:
-            new_env["SWAP_SIZE"] = payload.swap
-        svc["environment"] = new_env
+        }]}
+    if payload.swap:
+        svc["environment"]["SWAP_SIZE"] = payload.swap
+    meta = {"template": tpl["name"], "override": {"services": {"my_ws": svc}}}
 
-    save_compose(compose_path, data, payload.comment)
+    compose_path = dest / "docker-compose.yml"
+    with placement_lock() if PLACEMENT_ENABLED else nullcontext():
+        placement = place_container(payload.name, payload.cpus, payload.gpus)
+        if placement:
+            svc["cpuset"] = placement["cpuset"]
+        dest.mkdir(parents=True)
+        save_container_meta(dest, meta)
+        render_container(dest, meta, payload.comment)
+    if placement:
+        update_container_state(dest, placement=placement)
 
     # start container
     res = run_compose(compose_path, ["up", "-d"])
-    # run patch script to adjust the freshly created container
-    patch_script = PROJECT_ROOT / "scripts" / "patches.sh"
-    patch_result = None
-    try:
-        # poll for the container to appear (timeout 30s)
-        # expected container name format: <project>-<service>-1 where project is the folder name (payload.name)
-        container_name = f"{payload.name}-my_ws-1"
-        found = False
-        start = time.time()
-        timeout = 30
-        interval = 1
-        while time.time() - start < timeout:
-            try:
-                for cname, _ in _docker_ps_map():
-                    if cname == container_name or container_name in cname:
-                        found = True
-                        break
-            except Exception:
-                found = False
-            if found:
-                logging.info("Container %s appeared after %.1fs", container_name, time.time() - start)
-                break
-            time.sleep(interval)
-        if not found:
-            logging.warning("Container %s did not appear within %s seconds, proceeding to run patch script anyway", container_name, timeout)
-        proc = subprocess.run(["/bin/bash", str(patch_script), container_name], capture_output=True, text=True, check=False)
-        logging.info("PATCH CMD: %s %s RETURN: %s", str(patch_script), container_name, proc.returncode)
-        if proc.stdout:
-            logging.info("PATCH STDOUT: %s", proc.stdout)
-        if proc.stderr:
-            logging.info("PATCH STDERR: %s", proc.stderr)
-        patch_result = {"returncode": proc.returncode, "stdout": proc.stdout, "stderr": proc.stderr}
-    except FileNotFoundError as e:
-        logging.error("PATCH SCRIPT NOT FOUND: %s", str(e))
-        patch_result = {"returncode": 127, "stdout": "", "stderr": str(e)}
-    except Exception as e:
-        logging.exception("error running patch script: %s", e)
-        patch_result = {"returncode": 1, "stdout": "", "stderr": str(e)}
-    return {"compose_result": res, "patch_result": patch_result, "root_password": root_pw}
+    mark_desired(dest, True, res)
+    audit("create", payload.name, payload.image, res["returncode"], template=tpl["name"])
+    notify_changed(payload.name)
+    return {"compose_result": res, "host_port": host_port, "root_password": root_pw}
 
 @app.get("/api/containers")
-def list_containers():
-    results = []
-    for p in sorted(CONTAINERS_DIR.iterdir()):
-        if not p.is_dir():
-            continue
-        compose_path = p / "docker-compose.yml"
-        if not compose_path.exists():
-            continue
-        data = load_compose(compose_path)
-        if data is None:
-            continue
-        info = parse_compose_info(data)
-        info.name = p.name
-        # read optional top comment line from compose file
-        try:
-            with compose_path.open() as f:
-                first = f.readline().strip()
-                if first.startswith("# comment:"):
-                    info.comment = first[len("# comment:"):].strip()
-        except Exception:
-            pass
-        # determine state from `docker ps -a` STATUS field
-        state = None
-        for cname, cstatus in _docker_ps_map():
-            if p.name in cname:
-                state = cstatus
-                break
-        info.state = state or "idle"
-        results.append(info)
-    return results
+def list_containers(request: Request):
+    """Return all containers. The response carries the fleet version as ETag;
+    a matching If-None-Match gets 304 Not Modified."""
+    version, body, encoded = get_fleet_payload()
+    etag = f'"fleet-{FLEET_EPOCH}-{version}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return encode_response(request, body, headers, cache=encoded)
 
 @app.put("/api/containers/{name}")
 def modify_container(name: str, payload: ContainerModify):
+    # only existing containers get a lock (and a lock file)
+    if not (CONTAINERS_DIR / name).is_dir():
+        raise HTTPException(status_code=404, detail="not found")
+    with container_lock(name):
+        return _modify_container(name, payload)
+
+
+def _modify_container(name: str, payload: ContainerModify):
     path = CONTAINERS_DIR / name
     if not path.exists():
         raise HTTPException(status_code=404, detail="not found")
     compose_path = path / "docker-compose.yml"
-    data = load_compose(compose_path)
-    if data is None:
-        raise HTTPException(status_code=500, detail="invalid compose")
+    current_revision = read_container_state(path).get("revision", 0)
+    if payload.revision is not None and payload.revision != current_revision:
+        raise HTTPException(status_code=409, detail=f"container was modified concurrently (revision {current_revision})")
+    # template-managed containers are modified through their override, where
+    # a None value removes the key from the rendered compose file
+    meta = load_container_meta(path)
+    if meta is not None:
+        data = meta["override"]
+    else:
+        data = load_compose(compose_path)
+        if data is None:
+            raise HTTPException(status_code=500, detail="invalid compose")
+
+    def drop(d: dict, key: str):
+        if meta is not None:
+            d[key] = None
+        else:
+            d.pop(key, None)
+
     svc = data.setdefault("services", {}).setdefault("my_ws", {})
     deploy = svc.setdefault("deploy", {})
     resources = deploy.setdefault("resources", {})
@@ -528,13 +1677,13 @@ def modify_container(name: str, payload: ContainerModify):
                 "capabilities": ["gpu"],
             }]
         else:
-            reservations.pop("devices", None)
+            drop(reservations, "devices")
     # update shm_size when modifying
     if payload.shm_size is not None:
         if payload.shm_size:
             svc["shm_size"] = payload.shm_size
         else:
-            svc.pop("shm_size", None)
+            drop(svc, "shm_size")
     env = svc.get("environment")
     # handle both dict and list formats for environment
     if payload.root_password is not None:
@@ -557,7 +1706,35 @@ def modify_container(name: str, payload: ContainerModify):
             env = svc["environment"]
 
     # preserve or update top comment when saving
-    save_compose(compose_path, data, payload.comment if getattr(payload, 'comment', None) is not None else None)
+    comment = payload.comment if getattr(payload, 'comment', None) is not None else None
+    # re-place pinned desktops when their cpu count or GPUs change
+    replaced = (payload.cpus is not None or payload.gpus is not None) and bool(svc.get("cpuset"))
+    with placement_lock() if replaced and PLACEMENT_ENABLED else nullcontext():
+        if replaced:
+            gpus = payload.gpus if payload.gpus is not None else [
+                g for dev in (reservations.get("devices") or []) for g in dev.get("device_ids", [])]
+            try:
+                ncpus = int(float(limits.get("cpus")))
+            except (TypeError, ValueError):
+                ncpus = 0
+            placement = place_container(name, ncpus, gpus)
+            if placement:
+                svc["cpuset"] = placement["cpuset"]
+            else:
+                drop(svc, "cpuset")
+        if meta is not None:
+            save_container_meta(path, meta)
+            try:
+                render_container(path, meta, comment)
+            except KeyError as e:
+                raise HTTPException(status_code=500, detail=f"compose template {e} not found")
+        else:
+            save_compose(compose_path, data, comment)
+    if replaced:
+        update_container_state(path, placement=placement)
+    changed = [f for f in ("cpus", "memory", "gpus", "shm_size", "swap", "root_password", "comment")
+               if getattr(payload, f, None) is not None]
+    audit("modify", name, ",".join(changed), realtime=bool(payload.realtime_update))
 
     # Check if realtime update is requested
     if payload.realtime_update:
@@ -570,6 +1747,7 @@ def modify_container(name: str, payload: ContainerModify):
                 target_cname = cname
                 break
         if not target_cname:
+            notify_changed(name)
             return {"compose_result": "updated_compose_only", "live_result": {"error": "container not found for live update"}}
         # Get full container ID
         proc = subprocess.run(["docker", "inspect", target_cname, "--format", "{{.Id}}"], capture_output=True, text=True, check=False)
@@ -616,43 +1794,879 @@ def modify_container(name: str, payload: ContainerModify):
                 # Restart Docker
                 subprocess.run(["systemctl", "start", "docker.socket"], check=False)
                 subprocess.run(["systemctl", "start", "docker"], check=False)
+        audit("live_update", name, target_cname, 0 if live_result.get("updated") else 1,
+              stderr=live_result.get("error"))
+        if live_result.get("updated"):
+            # the live config now matches the compose file
+            update_container_state(path, applied_digest=compose_digest(compose_path))
+        notify_changed(name)
         return {"compose_result": "updated_no_restart", "live_result": live_result}
     else:
         # Recreate the container
         res = run_compose(compose_path, ["up", "-d", "--force-recreate"])
+        mark_desired(path, True, res)
+        notify_changed(name)
         return {"compose_result": res}
 
-@app.post("/api/containers/{name}/action")
-def container_action(name: str, action: str):
+# Per-container action queue
+#
+# start/stop/restart/delete requests for one container go through a queue with
+# at most one running and one pending operation. A request equal to the running
+# (or pending) operation joins it and gets its result instead of running compose
+# again; a new request while one is pending is folded into the pending one
+# (stop then start -> start, anything with restart -> restart, delete wins).
+ACTIONS = ("start", "stop", "restart", "delete")
+OP_STATS_WINDOW = 200
+
+
+class ContainerOp:
+    def __init__(self, action: str):
+        self.action = action
+        self.enqueued = time.monotonic()
+        self.started: Optional[float] = None
+        self.waiters = 1
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class ContainerOpQueue:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.running: Optional[ContainerOp] = None
+        self.pending: Optional[ContainerOp] = None
+
+
+_op_queues: Dict[str, ContainerOpQueue] = {}
+_op_queues_lock = threading.Lock()
+_op_stats = {"executed": 0, "coalesced": 0, "waits": deque(maxlen=OP_STATS_WINDOW)}
+
+
+def _net_action(pending: str, new: str) -> Optional[str]:
+    """Action equivalent to running `pending` then `new`; None if `new` cannot be queued."""
+    if new == pending or new == "delete":
+        return new
+    if pending == "delete":
+        return None
+    if new != "stop" and "restart" in (pending, new):
+        return "restart"
+    return new
+
+
+def _wait_op(name: str, op: ContainerOp, requested: str):
+    op.done.wait()
+    with _op_queues_lock:
+        _op_stats["coalesced"] += 1
+    logging.info("action %s on %s coalesced into %s", requested, name, op.action)
+    audit(requested, name, detail=f"coalesced into {op.action}",
+          returncode=0 if op.error is None else 1)
+    if op.error is not None:
+        raise op.error
+    return op.result
+
+
+def queue_action(name: str, action: str, run):
+    """Run `run(action)` for the container through its action queue and return
+    (result, info) where info tells whether the request was coalesced and how
+    long it waited."""
+    with _op_queues_lock:
+        q = _op_queues.setdefault(name, ContainerOpQueue())
+    with q.cond:
+        if q.running is not None and q.pending is None and q.running.action == action:
+            op = q.running
+            op.waiters += 1
+            joined = True
+        elif q.pending is not None:
+            net = _net_action(q.pending.action, action)
+            if net is None:
+                raise HTTPException(status_code=409, detail="container is being deleted")
+            q.pending.action = net
+            q.pending.waiters += 1
+            op = q.pending
+            joined = True
+        else:
+            op = ContainerOp(action)
+            joined = False
+            if q.running is None:
+                q.running = op
+            else:
+                q.pending = op
+                while q.running is not None:
+                    q.cond.wait()
+                q.pending = None
+                q.running = op
+    if joined:
+        result = _wait_op(name, op, action)
+        return result, {"coalesced": True, "action": op.action,
+                        "waited": round((op.started or op.enqueued) - op.enqueued, 3)}
+
+    op.started = time.monotonic()
+    waited = op.started - op.enqueued
+    if waited > 0.5:
+        logging.info("action %s on %s waited %.1fs in queue", op.action, name, waited)
+    try:
+        op.result = run(op.action)
+    except BaseException as e:
+        op.error = e
+    finally:
+        with _op_queues_lock:
+            _op_stats["executed"] += 1
+            _op_stats["waits"].append(waited)
+        with q.cond:
+            q.running = None
+            q.cond.notify_all()
+        op.done.set()
+    if op.error is not None:
+        raise op.error
+    return op.result, {"coalesced": op.waiters > 1, "action": op.action, "waited": round(waited, 3)}
+
+
+def _op_summary(op: Optional[ContainerOp]) -> Optional[dict]:
+    if op is None:
+        return None
+    now = time.monotonic()
+    return {
+        "action": op.action,
+        "waiters": op.waiters,
+        "queued_for": round((op.started or now) - op.enqueued, 3),
+        "running_for": round(now - op.started, 3) if op.started else None,
+    }
+
+
+def operation_queue_status() -> dict:
+    with _op_queues_lock:
+        queues = dict(_op_queues)
+        waits = sorted(_op_stats["waits"])
+        executed, coalesced = _op_stats["executed"], _op_stats["coalesced"]
+    containers = {}
+    for name, q in queues.items():
+        with q.cond:
+            running, pending = _op_summary(q.running), _op_summary(q.pending)
+        if running or pending:
+            depth = (running or {}).get("waiters", 0) + (pending or {}).get("waiters", 0)
+            containers[name] = {"depth": depth, "running": running, "pending": pending}
+    return {
+        "containers": containers,
+        "executed": executed,
+        "coalesced": coalesced,
+        "wait_p50": round(waits[len(waits) // 2], 3) if waits else None,
+        "wait_max": round(waits[-1], 3) if waits else None,
+    }
+
+
+@app.get("/api/operations")
+def get_operations():
+    """Per-container queue depth and running/pending operations, plus wait-time stats."""
+    return operation_queue_status()
+
+
+@app.post("/api/containers/{name}/action")
+def container_action(name: str, action: str):
+    if action not in ACTIONS:
+        raise HTTPException(status_code=400, detail="invalid action")
+    if not (CONTAINERS_DIR / name).exists():
+        raise HTTPException(status_code=404, detail="not found")
+
+    def run(net_action: str):
+        with container_lock(name):
+            return _container_action(name, net_action)
+
+    result, info = queue_action(name, action, run)
+    if info["coalesced"] or info["action"] != action:
+        result = {**result, "coalesced": info["coalesced"], "action": info["action"]}
+    return result
+
+
+def _container_action(name: str, action: str):
     path = CONTAINERS_DIR / name
     if not path.exists():
         raise HTTPException(status_code=404, detail="not found")
     compose_path = path / "docker-compose.yml"
     if action not in ("start", "stop", "restart", "delete"):
         raise HTTPException(status_code=400, detail="invalid action")
+    start = time.monotonic()
     if action == "start":
         res = run_compose(compose_path, ["up", "-d"])
+        mark_desired(path, True, res)
+        audit(action, name, returncode=res["returncode"], duration=time.monotonic() - start)
+        notify_changed(name)
         return {"result": res}
     if action == "stop":
         res = run_compose(compose_path, ["down"])
+        # a failed stop leaves the desired state as it was, so reconcile doesn't
+        # take a state that was never reached as intended
+        if res["returncode"] == 0:
+            mark_desired(path, False)
+        audit(action, name, returncode=res["returncode"], duration=time.monotonic() - start)
+        notify_changed(name)
         return {"result": res}
     if action == "restart":
         run_compose(compose_path, ["down"])
         res = run_compose(compose_path, ["up", "-d"])
+        mark_desired(path, True, res)
+        audit(action, name, returncode=res["returncode"], duration=time.monotonic() - start)
+        notify_changed(name)
         return {"result": res}
     if action == "delete":
         run_compose(compose_path, ["down"])
         # remove folder
         try:
             shutil.rmtree(path)
+            audit(action, name, returncode=0, duration=time.monotonic() - start)
+            try:
+                # drop exec output blobs only the deleted container referenced
+                gc_blobs()
+            except Exception:
+                logging.exception("exec output blob cleanup failed")
+            notify_changed(name)
             return {"result": "deleted"}
         except Exception as e:
+            audit(action, name, returncode=1, duration=time.monotonic() - start, stderr=str(e))
             raise HTTPException(status_code=500, detail=str(e))
 
 
+# Reconcile
+#
+# Desired state: every container dir with a compose file (or a template to
+# render it from) plus the `desired_running` flag in vdesk.json. A container
+# without the flag (created before it existed; the old stop ran `compose down`)
+# adopts its current state, so stopped desktops are not started behind an
+# admin's back.
+# Actual state: one `docker ps -a` pass, matched by compose project label.
+
+RECONCILE_CONCURRENCY = int(os.environ.get("VDESK_RECONCILE_CONCURRENCY", "4"))
+# seconds between background reconcile passes, 0 disables the loop
+RECONCILE_INTERVAL = int(os.environ.get("VDESK_RECONCILE_INTERVAL", "0"))
+RECONCILE_ON_STARTUP = os.environ.get("VDESK_RECONCILE_ON_STARTUP", "1") == "1"
+_reconcile_lock = asyncio.Lock()
+_last_reconcile: Optional[dict] = None
+_background_tasks = set()
+
+
+def _docker_ps_projects() -> Dict[str, List[dict]]:
+    """Return compose project name -> containers ({name, status, running}) from one `docker ps -a`."""
+    fmt = '{{.Names}}|||{{.Status}}|||{{.Label "com.docker.compose.project"}}'
+    try:
+        proc = subprocess.run(["docker", "ps", "-a", "--format", fmt], capture_output=True, text=True, check=False)
+        logging.info("CMD: docker ps -a --format '%s' RETURN: %s", fmt, proc.returncode,
+                     extra={"sample_key": "docker_ps_projects"})
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr.strip() or "docker ps failed")
+    except FileNotFoundError:
+        raise RuntimeError("docker command not found")
+    projects: Dict[str, List[dict]] = {}
+    for line in (proc.stdout or "").splitlines():
+        parts = line.strip().split("|||")
+        if len(parts) != 3 or not parts[2]:
+            # not a compose-managed container
+            continue
+        name, status, project = parts
+        projects.setdefault(project, []).append(
+            {"name": name, "status": status, "running": status.startswith("Up")})
+    return projects
+
+
+def plan_reconcile(prune: bool = False, dry_run: bool = False) -> List[dict]:
+    """Compare desired and actual state and return the minimal list of actions:
+    render (compose file missing or stale vs. its template), start, update
+    (running but compose changed since last applied), stop, remove (orphaned
+    containers without a compose dir, only with `prune`). Containers without a
+    desired state get their current one recorded, except on a dry run.
+    """
+    actual = _docker_ps_projects()
+    plan = []
+    seen = set()
+    if CONTAINERS_DIR.exists():
+        for p in sorted(CONTAINERS_DIR.iterdir()):
+            if not p.is_dir():
+                continue
+            compose_path = p / "docker-compose.yml"
+            state = read_container_state(p)
+            meta = load_container_meta(p)
+            if meta is not None and meta["template"] in TEMPLATES:
+                rendered = deep_merge(TEMPLATES[meta["template"]]["base"], meta["override"])
+                if load_compose(compose_path) != rendered:
+                    plan.append({"name": p.name, "action": "render", "reason": "compose differs from template"})
+            elif not compose_path.exists():
+                continue
+            seen.add(p.name)
+            containers = actual.get(p.name, [])
+            running = any(c["running"] for c in containers)
+            desired = state.get("desired_running")
+            if desired is None:
+                # nothing to do either way; a dry run must not write the flag
+                if not dry_run:
+                    adopt_desired_state(p, running)
+                continue
+            if desired and not running:
+                reason = "not created" if not containers else "not running"
+                plan.append({"name": p.name, "action": "start", "reason": reason})
+            elif not desired and running:
+                plan.append({"name": p.name, "action": "stop", "reason": "desired stopped"})
+            elif desired and running:
+                applied = state.get("applied_digest")
+                if applied and applied != compose_digest(compose_path):
+                    plan.append({"name": p.name, "action": "update", "reason": "compose changed since last applied"})
+    for project, containers in sorted(actual.items()):
+        if project in seen or not (project.isdigit() and len(project) == 6):
+            # only desktops (6-digit projects) are owned by this service
+            continue
+        for c in containers:
+            plan.append({"name": project, "container": c["name"], "action": "remove" if prune else "orphan",
+                         "reason": "no compose dir"})
+    return plan
+
+
+def adopt_desired_state(path: Path, running: bool):
+    """Record a container's current state as its desired state, unless it got
+    a flag meanwhile (or is busy; the next pass tries again)."""
+    try:
+        with container_lock(path.name, timeout=0):
+            if "desired_running" not in read_container_state(path):
+                update_container_state(path, desired_running=running)
+                logging.info("reconcile: adopted %s as desired state of %s",
+                             "running" if running else "stopped", path.name)
+    except ContainerBusy:
+        pass
+    except Exception:
+        logging.exception("failed to record desired state for %s", path.name)
+
+
+def _apply_action(item: dict) -> dict:
+    if item["action"] in ("remove", "orphan"):
+        return _apply_action_locked(item)
+    with container_lock(item["name"]):
+        return _apply_action_locked(item)
+
+
+def _apply_action_locked(item: dict) -> dict:
+    path = CONTAINERS_DIR / item["name"]
+    compose_path = path / "docker-compose.yml"
+    action = item["action"]
+    if action == "render":
+        render_container(path, load_container_meta(path))
+        return {"returncode": 0, "stdout": "", "stderr": ""}
+    if action in ("start", "update"):
+        res = run_compose(compose_path, ["up", "-d"])
+        mark_desired(path, True, res)
+        return res
+    if action == "stop":
+        return run_compose(compose_path, ["down"])
+    if action == "remove":
+        proc = subprocess.run(["docker", "rm", "-f", item["container"]], capture_output=True, text=True, check=False)
+        logging.info("CMD: docker rm -f %s RETURN: %s", item["container"], proc.returncode)
+        audit("remove_orphan", item["name"], item["container"], proc.returncode, stdout=proc.stdout, stderr=proc.stderr)
+        return {"returncode": proc.returncode, "stdout": proc.stdout, "stderr": proc.stderr}
+    # orphans are only reported
+    return {"returncode": 0, "stdout": "", "stderr": "reported only"}
+
+
+async def apply_plan(plan: List[dict], concurrency: int) -> List[dict]:
+    """Apply a reconcile plan with at most `concurrency` compose commands at once.
+    Actions on the same container run in plan order (render before start)."""
+    sem = asyncio.Semaphore(max(1, concurrency))
+    by_name: Dict[str, List[dict]] = {}
+    for item in plan:
+        by_name.setdefault(item["name"], []).append(item)
+
+    async def run_container(items):
+        out = []
+        for item in items:
+            async with sem:
+                started = time.monotonic()
+                try:
+                    res = await asyncio.to_thread(_apply_action, item)
+                except Exception as e:
+                    logging.exception("reconcile action %s on %s failed", item["action"], item["name"])
+                    res = {"returncode": 1, "stdout": "", "stderr": str(e)}
+            out.append({**item, "returncode": res["returncode"], "stderr": res.get("stderr", ""),
+                        "duration": round(time.monotonic() - started, 3)})
+            if res["returncode"] != 0:
+                break
+        return out
+
+    results = await asyncio.gather(*(run_container(items) for items in by_name.values()))
+    return [r for rs in results for r in rs]
+
+
+async def reconcile(dry_run: bool = False, prune: bool = False, concurrency: int = RECONCILE_CONCURRENCY) -> dict:
+    global _last_reconcile
+    started = time.monotonic()
+    async with _reconcile_lock:
+        plan = await asyncio.to_thread(plan_reconcile, prune, dry_run)
+        results = [] if dry_run else await apply_plan(plan, concurrency)
+    report = {
+        "dry_run": dry_run,
+        "timestamp": datetime.utcnow().isoformat() + 'Z',
+        "plan": plan,
+        "results": results,
+        "failed": [r["name"] for r in results if r["returncode"] != 0],
+        "duration": round(time.monotonic() - started, 3),
+    }
+    if not dry_run:
+        _last_reconcile = report
+        logging.info("reconcile applied %d action(s) in %.1fs, %d failed",
+                     len(results), report["duration"], len(report["failed"]))
+        audit("reconcile", returncode=1 if report["failed"] else 0, duration=report["duration"],
+              actions=len(results), failed=report["failed"])
+        if results:
+            await asyncio.to_thread(refresh_fleet)
+    return report
+
+
+@app.get('/api/reconcile')
+async def reconcile_status(prune: bool = False):
+    """Return the current drift as an action plan without applying it."""
+    try:
+        return await reconcile(dry_run=True, prune=prune)
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+@app.post('/api/reconcile')
+async def reconcile_now(dry_run: bool = False, prune: bool = False, concurrency: int = RECONCILE_CONCURRENCY):
+    """Compute and (unless dry_run) apply the reconcile plan."""
+    if not dry_run and _reconcile_lock.locked():
+        raise HTTPException(status_code=409, detail="reconcile already running")
+    try:
+        return await reconcile(dry_run=dry_run, prune=prune, concurrency=concurrency)
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+@app.get('/api/reconcile/last')
+def reconcile_last():
+    """Return the report of the last applied reconcile pass."""
+    return _last_reconcile or {}
+
+
+async def _reconcile_loop():
+    if RECONCILE_ON_STARTUP:
+        try:
+            await reconcile()
+        except Exception:
+            logging.exception("startup reconcile failed")
+    while RECONCILE_INTERVAL > 0:
+        await asyncio.sleep(RECONCILE_INTERVAL)
+        try:
+            await reconcile()
+        except Exception:
+            logging.exception("periodic reconcile failed")
+
+
+async def _fleet_watch_loop():
+    """Pick up state changes made outside the API while anyone watches the feed."""
+    while True:
+        await asyncio.sleep(max(1.0, FLEET_CACHE_TTL))
+        if not _feed_subscribers:
+            continue
+        try:
+            await asyncio.to_thread(refresh_fleet)
+        except Exception:
+            logging.exception("container list refresh failed")
+
+
+async def _probe_loop():
+    while True:
+        try:
+            await probe_fleet()
+        except Exception:
+            logging.exception("readiness probe pass failed")
+        await asyncio.sleep(PROBE_INTERVAL)
+
+
+# In-container patches
+#
+# Patches are ordered shell snippets in scripts/patches/NNN-name.sh (the numeric
+# prefix gives the order, the first "# description:" line documents it). All
+# pending patches for a container are sent as one script over a single
+# `docker exec -i ... bash -s`. Each applied patch leaves a marker
+# PATCH_MARKER_DIR/<id>@<digest> inside the container, so re-running is cheap and
+# a recreated container (fresh filesystem) gets patched again; editing a patch
+# changes its digest and re-applies it. Results are recorded in vdesk.json.
+
+PATCHES_DIR = PROJECT_ROOT / "scripts" / "patches"
+PATCH_MARKER_DIR = "/var/lib/vdesk/patches"
+PATCH_TIMEOUT = int(os.environ.get("VDESK_PATCH_TIMEOUT", "300"))
+PATCH_CONCURRENCY = int(os.environ.get("VDESK_PATCH_CONCURRENCY", "4"))
+
+
+class PatchRollout(BaseModel):
+    names: Optional[List[str]] = None
+    patches: Optional[List[str]] = None
+    concurrency: Optional[int] = None
+
+
+def load_patches() -> List[dict]:
+    """Return the patches in apply order as {id, description, digest, body}."""
+    patches = []
+    if not PATCHES_DIR.is_dir():
+        return patches
+    for f in sorted(PATCHES_DIR.glob("*.sh")):
+        body = f.read_text()
+        description = ""
+        for line in body.splitlines():
+            if line.startswith("# description:"):
+                description = line.split(":", 1)[1].strip()
+                break
+        patches.append({
+            "id": f.stem,
+            "description": description,
+            "digest": hashlib.sha256(body.encode()).hexdigest()[:12],
+            "body": body,
+        })
+    return patches
+
+
+def build_patch_script(patches: List[dict]) -> str:
+    """One bash script applying `patches` in order, skipping those already marked
+    and stopping at the first failure. Reports `VDESK-PATCH <id> <rc|skip>` lines."""
+    lines = ["set -u", f"mkdir -p {PATCH_MARKER_DIR}"]
+    for p in patches:
+        marker = shlex.quote(f"{PATCH_MARKER_DIR}/{p['id']}@{p['digest']}")
+        lines += [
+            f"if [ -e {marker} ]; then echo 'VDESK-PATCH {p['id']} skip'; else",
+            "( set -e",
+            p["body"].rstrip("\n"),
+            ")",
+            "rc=$?",
+            f"[ $rc -eq 0 ] && touch {marker}",
+            f"echo \"VDESK-PATCH {p['id']} $rc\"",
+            "[ $rc -eq 0 ] || exit $rc",
+            "fi",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def apply_patches(name: str, container_name: Optional[str] = None, only: Optional[List[str]] = None) -> dict:
+    """Apply pending patches to a running container in one exec and record the
+    outcome in its vdesk.json. The caller holds the container lock."""
+    path = CONTAINERS_DIR / name
+    container_name = container_name or f"{name}-my_ws-1"
+    patches = [p for p in load_patches() if only is None or p["id"] in only]
+    status = {p["id"]: "not run" for p in patches}
+    if not patches:
+        return {"returncode": 0, "stdout": "", "stderr": "", "patches": status}
+    script = build_patch_script(patches)
+    start = time.monotonic()
+    try:
+        proc = subprocess.run(["docker", "exec", "-i", "-u", "root", container_name, "/bin/bash", "-s"],
+                              input=script, capture_output=True, text=True, check=False, timeout=PATCH_TIMEOUT)
+        rc, stdout, stderr = proc.returncode, proc.stdout, proc.stderr
+    except subprocess.TimeoutExpired:
+        rc, stdout, stderr = 124, "", f"patching timed out after {PATCH_TIMEOUT}s"
+    except FileNotFoundError:
+        rc, stdout, stderr = 127, "", "docker command not found"
+    duration = time.monotonic() - start
+    for line in stdout.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[0] == "VDESK-PATCH" and parts[1] in status:
+            status[parts[1]] = "skipped" if parts[2] == "skip" else ("applied" if parts[2] == "0" else "failed")
+    done = [p for p in patches if status[p["id"]] in ("applied", "skipped")]
+    if done and path.exists():
+        now = datetime.now(timezone.utc).isoformat()
+        recorded = dict(read_container_state(path).get("patches") or {})
+        for p in done:
+            if recorded.get(p["id"], {}).get("digest") != p["digest"] or status[p["id"]] == "applied":
+                recorded[p["id"]] = {"digest": p["digest"], "applied_at": now}
+        update_container_state(path, patches=recorded)
+    applied = [pid for pid, s in status.items() if s == "applied"]
+    logging.info("PATCH %s: applied %s RETURN: %s (%.2fs)", container_name, ",".join(applied) or "nothing", rc, duration)
+    audit("patch", name, ",".join(applied) or "nothing to apply", rc, duration, stdout, stderr)
+    return {"returncode": rc, "stdout": stdout, "stderr": stderr, "patches": status}
+
+
+@app.get("/api/patches")
+def list_patches():
+    """Patches in apply order with the number of containers that recorded the current version."""
+    patches = load_patches()
+    recorded = []
+    if CONTAINERS_DIR.exists():
+        recorded = [read_container_state(p).get("patches") or {} for p in CONTAINERS_DIR.iterdir() if p.is_dir()]
+    return [{
+        "id": p["id"],
+        "description": p["description"],
+        "digest": p["digest"],
+        "containers": sum(1 for r in recorded if r.get(p["id"], {}).get("digest") == p["digest"]),
+    } for p in patches]
+
+
+@app.get("/api/containers/{name}/patches")
+def get_container_patches(name: str):
+    path = CONTAINERS_DIR / name
+    if not path.exists():
+        raise HTTPException(status_code=404, detail="not found")
+    recorded = read_container_state(path).get("patches") or {}
+    return [{"id": p["id"], "digest": p["digest"],
+             "applied_at": recorded.get(p["id"], {}).get("applied_at"),
+             "current": recorded.get(p["id"], {}).get("digest") == p["digest"]}
+            for p in load_patches()]
+
+
+@app.post("/api/containers/{name}/patches")
+def patch_container(name: str):
+    if not (CONTAINERS_DIR / name).exists():
+        raise HTTPException(status_code=404, detail="not found")
+    with container_lock(name):
+        return apply_patches(name)
+
+
+@app.post("/api/patches/rollout")
+async def rollout_patches(payload: PatchRollout):
+    """Apply pending patches to running containers (all, or `names`), at most
+    `concurrency` containers at a time."""
+    projects = await asyncio.to_thread(_docker_ps_projects)
+    targets = []
+    for name in sorted(payload.names or (p.name for p in CONTAINERS_DIR.iterdir() if p.is_dir())):
+        running = [c for c in projects.get(name, []) if c["running"]]
+        if (CONTAINERS_DIR / name).exists() and running:
+            targets.append((name, running[0]["name"]))
+    sem = asyncio.Semaphore(max(1, payload.concurrency or PATCH_CONCURRENCY))
+
+    async def run(name: str, container_name: str):
+        async with sem:
+            try:
+                async with container_lock_async(name):
+                    res = await asyncio.to_thread(apply_patches, name, container_name, payload.patches)
+            except ContainerBusy:
+                res = {"returncode": 1, "stdout": "", "stderr": "container is busy", "patches": {}}
+        return {"name": name, "returncode": res["returncode"], "patches": res["patches"],
+                "stderr": res["stderr"]}
+
+    results = await asyncio.gather(*(run(n, c) for n, c in targets))
+    failed = [r["name"] for r in results if r["returncode"] != 0]
+    audit("patch_rollout", detail=f"{len(results)} containers, {len(failed)} failed",
+          returncode=1 if failed else 0)
+    return {"results": results, "failed": failed}
+
+
+# Disk usage
+#
+# Sizes of each container's named volumes (found with one `docker inspect`),
+# computed by a background scanner that walks one container at a time and is
+# throttled to DISK_SCAN_RATE stat calls per second. A directory whose mtime is
+# unchanged since the last pass reuses its cached file total instead of listing
+# and stat-ing its files again; only its subdirectories are re-checked. File
+# growth in place doesn't change the directory mtime, so every
+# DISK_FULL_SCAN_EVERY-th pass re-reads everything. API requests never walk a
+# volume themselves; they queue a scan of that container and return what is
+# cached (or "pending").
+DISK_SCAN_INTERVAL = int(os.environ.get("VDESK_DISK_SCAN_INTERVAL", "3600"))
+DISK_SCAN_RATE = int(os.environ.get("VDESK_DISK_SCAN_RATE", "2000"))
+DISK_FULL_SCAN_EVERY = int(os.environ.get("VDESK_DISK_FULL_SCAN_EVERY", "24"))
+_disk_usage: Dict[str, dict] = {}
+# directory path -> (mtime_ns, bytes of its files, file count, subdirectory names)
+_dir_cache: Dict[str, tuple] = {}
+_disk_scan_lock = threading.Lock()
+# guards iteration over (and changes to) _dir_cache and _disk_usage, which
+# refresh scans change from other threads
+_disk_cache_lock = threading.Lock()
+_disk_passes = 0
+_disk_scans_queued = set()
+
+
+def container_volume_mounts(names: List[str]) -> Dict[str, List[dict]]:
+    """Return container name -> its named volumes ({volume, source, destination})
+    using one `docker inspect` for all existing containers."""
+    projects = _docker_ps_projects()
+    targets = {c["name"]: name for name in names for c in projects.get(name, [])}
+    mounts: Dict[str, List[dict]] = {name: [] for name in names}
+    if not targets:
+        return mounts
+    proc = subprocess.run(["docker", "inspect", "--format", "{{.Name}}|||{{json .Mounts}}", *targets],
+                          capture_output=True, text=True, check=False)
+    for line in (proc.stdout or "").splitlines():
+        cname, _, raw = line.partition("|||")
+        name = targets.get(cname.lstrip("/"))
+        if name is None:
+            continue
+        try:
+            entries = json.loads(raw) or []
+        except ValueError:
+            continue
+        for m in entries:
+            if m.get("Type") == "volume" and m.get("Source"):
+                mounts[name].append({"volume": m.get("Name"), "source": m["Source"],
+                                     "destination": m.get("Destination")})
+    return mounts
+
+
+class _Throttle:
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.ops = 0
+        self.start = time.monotonic()
+
+    def tick(self):
+        self.ops += 1
+        if self.rate > 0 and self.ops % 256 == 0:
+            ahead = self.ops / self.rate - (time.monotonic() - self.start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def _forget_dir(path: str):
+    """Drop a deleted directory and everything cached under it. Caller holds
+    _disk_cache_lock."""
+    stack = [path]
+    while stack:
+        path = stack.pop()
+        cached = _dir_cache.pop(path, None)
+        if cached is not None:
+            stack.extend(os.path.join(path, d) for d in cached[3])
+
+
+def scan_tree(root: str, throttle: _Throttle, full: bool = False) -> dict:
+    """Return {bytes, files, dirs, reused} for the tree under root, staying on
+    its filesystem and not following symlinks."""
+    total = {"bytes": 0, "files": 0, "dirs": 0, "reused": 0}
+    try:
+        dev = os.lstat(root).st_dev
+    except OSError:
+        return total
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        try:
+            st = os.lstat(path)
+        except OSError:
+            with _disk_cache_lock:
+                _forget_dir(path)
+            continue
+        throttle.tick()
+        total["dirs"] += 1
+        cached = _dir_cache.get(path)
+        if not full and cached is not None and cached[0] == st.st_mtime_ns:
+            _, nbytes, nfiles, subdirs = cached
+            total["reused"] += 1
+        else:
+            nbytes, nfiles, subdirs = st.st_blocks * 512, 0, []
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            est = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        throttle.tick()
+                        if entry.is_dir(follow_symlinks=False):
+                            if est.st_dev == dev:
+                                subdirs.append(entry.name)
+                        else:
+                            nbytes += est.st_blocks * 512
+                            nfiles += 1
+            except OSError:
+                pass
+            subdirs = tuple(subdirs)
+            with _disk_cache_lock:
+                # subdirectories removed since the last scan are never visited again
+                if cached is not None:
+                    for gone in set(cached[3]) - set(subdirs):
+                        _forget_dir(os.path.join(path, gone))
+                _dir_cache[path] = (st.st_mtime_ns, nbytes, nfiles, subdirs)
+        total["bytes"] += nbytes
+        total["files"] += nfiles
+        stack.extend(os.path.join(path, d) for d in subdirs)
+    return total
+
+
+def scan_container_disk(name: str, mounts: List[dict], full: bool = False) -> dict:
+    start = time.monotonic()
+    throttle = _Throttle(DISK_SCAN_RATE)
+    volumes = []
+    for m in mounts:
+        usage = scan_tree(m["source"], throttle, full)
+        volumes.append({**m, "bytes": usage["bytes"], "files": usage["files"], "dirs": usage["dirs"],
+                        "reused_dirs": usage["reused"]})
+    entry = {
+        "name": name,
+        "bytes": sum(v["bytes"] for v in volumes),
+        "volumes": volumes,
+        "scanned_at": datetime.now(timezone.utc).isoformat(),
+        "duration": round(time.monotonic() - start, 3),
+    }
+    with _disk_cache_lock:
+        _disk_usage[name] = entry
+    return entry
+
+
+def scan_disk_usage(names: Optional[List[str]] = None) -> List[dict]:
+    """Scan the volumes of `names` (all containers if None), one container at a
+    time. Whole-fleet passes also forget containers that no longer exist."""
+    global _disk_passes
+    full = False
+    existing = {p.name for p in CONTAINERS_DIR.iterdir() if p.is_dir()} if CONTAINERS_DIR.exists() else set()
+    if names is None:
+        names = sorted(existing)
+        with _disk_scan_lock:
+            _disk_passes += 1
+            full = DISK_FULL_SCAN_EVERY > 0 and (_disk_passes - 1) % DISK_FULL_SCAN_EVERY == 0
+        with _disk_cache_lock:
+            for gone in set(_disk_usage) - existing:
+                sources = tuple(v["source"] for v in _disk_usage.pop(gone)["volumes"])
+                for path in [p for p in _dir_cache if sources and p.startswith(sources)]:
+                    _dir_cache.pop(path, None)
+    mounts = container_volume_mounts(names)
+    return [scan_container_disk(name, mounts.get(name, []), full) for name in names]
+
+
+async def _scan_container_in_background(name: str):
+    try:
+        await asyncio.to_thread(scan_disk_usage, [name])
+    except Exception:
+        logging.exception("disk usage scan of %s failed", name)
+    finally:
+        _disk_scans_queued.discard(name)
+
+
+@app.get('/api/containers/{name}/disk')
+async def get_container_disk(name: str, refresh: bool = False):
+    """Cached volume usage of a container with `status` 'ok', or 'scanning'
+    while a scan queued by refresh=true runs. A container not scanned yet gets
+    202 {status: 'pending'} and is scanned in the background."""
+    if not (CONTAINERS_DIR / name).exists():
+        raise HTTPException(status_code=404, detail='not found')
+    entry = _disk_usage.get(name)
+    if (refresh or entry is None) and name not in _disk_scans_queued:
+        _disk_scans_queued.add(name)
+        _start_background(_scan_container_in_background(name))
+    if entry is None:
+        return JSONResponse(status_code=202, content={"name": name, "status": "pending"})
+    return {**entry, "status": "scanning" if name in _disk_scans_queued else "ok"}
+
+
+@app.get('/api/disk/top')
+def get_disk_top(n: int = 10):
+    """The `n` containers using the most volume space, from the last scans."""
+    with _disk_cache_lock:
+        items = list(_disk_usage.values())
+    items.sort(key=lambda e: e["bytes"], reverse=True)
+    return {"total_bytes": sum(e["bytes"] for e in items), "containers": len(items),
+            "top": [{k: e[k] for k in ("name", "bytes", "scanned_at")} for e in items[:max(0, n)]]}
+
+
+async def _disk_scan_loop():
+    while True:
+        try:
+            started = time.monotonic()
+            results = await asyncio.to_thread(scan_disk_usage)
+            logging.info("disk usage scan of %s containers took %.1fs", len(results), time.monotonic() - started)
+        except Exception:
+            logging.exception("disk usage scan failed")
+        await asyncio.sleep(DISK_SCAN_INTERVAL)
+
+
 @app.post('/api/containers/{name}/exec')
 def exec_in_container(name: str, payload: dict, request: Request = None):
     """Execute a shell command inside the container for the given logical name and record the result in a per-container exec log file."""
+    if not (CONTAINERS_DIR / name).is_dir():
+        raise HTTPException(status_code=404, detail="not found")
+    # exec may run alongside other execs, but not during a recreate
+    with container_lock(name, shared=True):
+        return _exec_in_container(name, payload, request)
+
+
+def _exec_in_container(name: str, payload: dict, request: Request = None):
     path = CONTAINERS_DIR / name
     if not path.exists():
         raise HTTPException(status_code=404, detail="not found")
@@ -682,28 +2696,135 @@ def exec_in_container(name: str, payload: dict, request: Request = None):
         user = None
 
     try:
+        exec_start = time.monotonic()
         proc = subprocess.run(["docker", "exec", "-u", "root", target_cname, "/bin/bash", "-c", cmd], capture_output=True, text=True, check=False)
-        try:
-            logging.info("EXEC CMD: docker exec %s %s RETURN: %s", target_cname, cmd, proc.returncode)
-            if proc.stdout:
-                logging.info("EXEC STDOUT: %s", proc.stdout)
-            if proc.stderr:
-                logging.info("EXEC STDERR: %s", proc.stderr)
-        except Exception:
-            pass
+        logging.info("EXEC CMD: docker exec %s %s RETURN: %s", target_cname, cmd, proc.returncode)
+        audit("exec", name, cmd, proc.returncode, time.monotonic() - exec_start, proc.stdout, proc.stderr, user=user)
 
         # Append to per-container exec log file (JSON list)
+        append_exec_log(name, user, cmd, proc.returncode, proc.stdout, proc.stderr)
+
+        return {"returncode": proc.returncode, "stdout": proc.stdout, "stderr": proc.stderr}
+    except FileNotFoundError as e:
+        logging.error("docker command not found when running exec: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+    except Exception as e:
+        logging.exception('failed to exec command in container: %s', e)
+        raise HTTPException(status_code=500, detail='failed to exec command')
+
+
+# Exec output blob store
+#
+# Exec log entries keep only a preview, size and hash of stdout/stderr; the
+# bodies are stored once per distinct content under BLOB_DIR/<hash[:2]>/<hash>,
+# compressed with zstd when the zstandard module is installed and gzip
+# otherwise, and decompressed only when a single entry is opened.
+BLOB_DIR = Path(os.environ.get("VDESK_BLOB_DIR", str(WEB_ROOT / "blobs")))
+EXEC_PREVIEW_CHARS = int(os.environ.get("VDESK_EXEC_PREVIEW_CHARS", "300"))
+# unreferenced blobs younger than this are kept; a concurrent exec may be about to log them
+BLOB_GC_MIN_AGE = 3600
+BLOB_CODECS = {".gz": (gzip.compress, gzip.decompress)}
+if zstandard is not None:
+    BLOB_CODECS[".zst"] = (lambda b: zstandard.ZstdCompressor(level=10).compress(b),
+                           lambda b: zstandard.ZstdDecompressor().decompress(b))
+BLOB_SUFFIX = ".zst" if zstandard is not None else ".gz"
+
+
+def put_blob(data: str) -> str:
+    """Store a body and return its sha256; identical bodies are stored once."""
+    raw = data.encode()
+    digest = hashlib.sha256(raw).hexdigest()
+    folder = BLOB_DIR / digest[:2]
+    for suffix in BLOB_CODECS:
         try:
-            logs_file = path / 'exec_logs.json'
-            entry = {
-                'id': uuid.uuid4().hex,
-                'timestamp': datetime.utcnow().isoformat() + 'Z',
-                'user': user,
-                'cmd': cmd,
-                'returncode': proc.returncode,
-                'stdout': proc.stdout,
-                'stderr': proc.stderr,
-            }
+            # touch a reused blob so gc_blobs' age guard covers the new reference
+            os.utime(folder / (digest + suffix))
+            return digest
+        except FileNotFoundError:
+            continue
+    folder.mkdir(parents=True, exist_ok=True)
+    tmp = folder / f".{digest}.{uuid.uuid4().hex}.tmp"
+    tmp.write_bytes(BLOB_CODECS[BLOB_SUFFIX][0](raw))
+    os.replace(tmp, folder / (digest + BLOB_SUFFIX))
+    return digest
+
+
+def get_blob(digest: str) -> Optional[str]:
+    """Return a stored body, None if it is missing or the hash is malformed."""
+    if len(digest) != 64 or any(ch not in "0123456789abcdef" for ch in digest):
+        return None
+    for suffix, (_, decompress) in BLOB_CODECS.items():
+        path = BLOB_DIR / digest[:2] / (digest + suffix)
+        if path.exists():
+            return decompress(path.read_bytes()).decode(errors="replace")
+    return None
+
+
+def _output_fields(kind: str, body: str) -> dict:
+    fields = {f"{kind}_size": len(body), f"{kind}_preview": body[:EXEC_PREVIEW_CHARS]}
+    if len(body) > EXEC_PREVIEW_CHARS:
+        fields[f"{kind}_hash"] = put_blob(body)
+    return fields
+
+
+def open_exec_log_entry(entry: dict) -> dict:
+    """Return an exec log entry with full stdout/stderr, loading blobs as needed."""
+    entry = dict(entry)
+    for kind in ("stdout", "stderr"):
+        if kind in entry:
+            # entries written before the blob store keep their bodies inline
+            continue
+        digest = entry.get(f"{kind}_hash")
+        body = get_blob(digest) if digest else entry.get(f"{kind}_preview", "")
+        entry[kind] = body if body is not None else ""
+    return entry
+
+
+def gc_blobs(min_age: float = BLOB_GC_MIN_AGE) -> int:
+    """Delete blobs no exec log references any more; returns the number removed."""
+    if not BLOB_DIR.exists():
+        return 0
+    referenced = set()
+    for logs_file in CONTAINERS_DIR.glob("*/exec_logs.json"):
+        try:
+            logs = json.loads(logs_file.read_text())
+        except (OSError, ValueError):
+            # can't tell what it references: keep everything
+            return 0
+        for entry in logs:
+            referenced.update(entry.get(k) for k in ("stdout_hash", "stderr_hash") if entry.get(k))
+    removed = 0
+    cutoff = time.time() - min_age
+    for path in BLOB_DIR.glob("*/*"):
+        digest = path.name.split(".")[0]
+        try:
+            if digest and digest not in referenced and path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+                removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
+
+
+_exec_log_lock = threading.Lock()
+
+
+def append_exec_log(name: str, user: Optional[str], cmd: str, returncode: int, stdout: str, stderr: str):
+    """Append an entry to the container's exec log file (JSON list), with the
+    output bodies moved to the blob store. Never raises."""
+    logs_file = CONTAINERS_DIR / name / 'exec_logs.json'
+    entry = {
+        'id': uuid.uuid4().hex,
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'user': user,
+        'cmd': cmd,
+        'returncode': returncode,
+    }
+    try:
+        entry.update(_output_fields('stdout', stdout or ''))
+        entry.update(_output_fields('stderr', stderr or ''))
+        # concurrent execs share the container lock, so serialize the read-modify-write
+        with _exec_log_lock:
             logs = []
             if logs_file.exists():
                 try:
@@ -712,43 +2833,582 @@ def exec_in_container(name: str, payload: dict, request: Request = None):
                 except Exception:
                     logs = []
             logs.append(entry)
-            try:
-                with logs_file.open('w') as f:
-                    json.dump(logs, f)
-            except Exception:
-                logging.exception('failed to write exec logs for %s', name)
-        except Exception:
-            logging.exception('failed to append exec log')
-
-        return {"returncode": proc.returncode, "stdout": proc.stdout, "stderr": proc.stderr}
-    except FileNotFoundError as e:
-        logging.error("docker command not found when running exec: %s", e)
-        raise HTTPException(status_code=500, detail=str(e))
-    except Exception as e:
-        logging.exception('failed to exec command in container: %s', e)
-        raise HTTPException(status_code=500, detail='failed to exec command')
+            atomic_write_text(logs_file, json.dumps(logs))
+    except Exception:
+        logging.exception('failed to write exec logs for %s', name)
 
 
 @app.get('/api/containers/{name}/exec-logs')
-def get_exec_logs(name: str):
-    """Return the list of exec logs for the container (newest last)."""
+def get_exec_logs(name: str, request: Request):
+    """Return the list of exec logs for the container (newest last) with
+    output previews; fetch a single entry for the full output. The file is
+    already JSON, so it is sent as stored."""
     path = CONTAINERS_DIR / name
     if not path.exists():
         raise HTTPException(status_code=404, detail='not found')
     logs_file = path / 'exec_logs.json'
+    if not logs_file.exists():
+        return []
+    try:
+        body = logs_file.read_bytes()
+    except Exception:
+        logging.exception('failed to read exec logs for %s', name)
+        raise HTTPException(status_code=500, detail='failed to read logs')
+    return encode_response(request, body)
+
+
+def read_exec_logs(name: str) -> List[dict]:
+    logs_file = CONTAINERS_DIR / name / 'exec_logs.json'
     if not logs_file.exists():
         return []
     try:
         with logs_file.open() as f:
-            logs = json.load(f)
-            return logs
+            return json.load(f)
     except Exception:
         logging.exception('failed to read exec logs for %s', name)
         raise HTTPException(status_code=500, detail='failed to read logs')
 
 
+@app.get('/api/containers/{name}/exec-logs/{log_id}')
+def get_exec_log_entry(name: str, log_id: str, request: Request):
+    """Return one exec log entry with its full stdout/stderr."""
+    if not (CONTAINERS_DIR / name).exists():
+        raise HTTPException(status_code=404, detail='not found')
+    for entry in read_exec_logs(name):
+        if entry.get('id') == log_id:
+            return encode_response(request, json_bytes(open_exec_log_entry(entry)))
+    raise HTTPException(status_code=404, detail='log entry not found')
+
+
+# Container logs
+#
+# `docker logs` of a desktop, so failed startups can be debugged without SSH to
+# the host. While anyone follows a container, one `docker logs -f` process feeds
+# a ring buffer of its last LOG_BUFFER_LINES lines. Each viewer gets its tail
+# from that buffer and then new lines through its own bounded queue, so ten
+# viewers cost one process. A viewer that falls LOG_VIEWER_QUEUE lines behind
+# gets a 'lagged' message instead of the lines it missed. The follower stops
+# LOG_FOLLOW_LINGER seconds after its last viewer leaves, or when the container
+# exits. A one-shot tail is served from the buffer when a follower is running.
+# Lines carry docker's timestamp, which is also how the follower tells the
+# buffered tail `docker logs -f` prints first from lines logged since it started.
+
+LOG_BUFFER_LINES = int(os.environ.get("VDESK_LOG_BUFFER_LINES", "2000"))
+LOG_VIEWER_QUEUE = int(os.environ.get("VDESK_LOG_VIEWER_QUEUE", "1000"))
+LOG_FOLLOW_LINGER = float(os.environ.get("VDESK_LOG_FOLLOW_LINGER", "30"))
+LOG_TAIL_MAX = int(os.environ.get("VDESK_LOG_TAIL_MAX", "10000"))
+# longer lines are cut; the read limit bounds memory for a line without newline
+LOG_LINE_MAX = 16 * 1024
+LOG_READ_LIMIT = 1024 * 1024
+# a silent container gives no newer line, so a quiet moment after the first
+# line (or this many seconds) also ends the buffered tail
+LOG_PRIME_QUIET = 0.3
+LOG_PRIME_TIMEOUT = 3.0
+
+_log_followers: Dict[str, "LogFollower"] = {}
+
+
+def resolve_container_name(name: str) -> Optional[str]:
+    """Docker container name for a desktop, matched the way exec does."""
+    for cname, _ in _docker_ps_map():
+        if cname == name or name in cname:
+            return cname
+    return None
+
+
+def _offer_line(q: asyncio.Queue, msg: dict):
+    try:
+        q.put_nowait(msg)
+    except asyncio.QueueFull:
+        # slow viewer: drop its backlog and tell it how many lines it lost
+        dropped = 0
+        while not q.empty():
+            if q.get_nowait()["type"] in ("stdout", "stderr"):
+                dropped += 1
+        if msg["type"] == "end":
+            q.put_nowait({"type": "lagged", "dropped": dropped})
+            q.put_nowait(msg)
+        else:
+            q.put_nowait({"type": "lagged", "dropped": dropped + 1})
+
+
+def _log_line(kind: str, raw: bytes) -> dict:
+    # "2026-10-19T03:00:00.123456789Z text\n"; the fraction is cut to
+    # microseconds so times compare as strings against datetime output
+    stamp, _, text = raw[:LOG_LINE_MAX].decode(errors="replace").partition(" ")
+    return {"type": kind, "time": stamp[:26], "data": text}
+
+
+class LogFollower:
+    """One `docker logs -f` process for a container and the viewers reading it."""
+
+    def __init__(self, name: str, cname: str):
+        self.name = name
+        self.cname = cname
+        self.lines: deque = deque(maxlen=LOG_BUFFER_LINES)
+        self.viewers: set = set()
+        self.primed = asyncio.Event()
+        self.done = False
+        self.received = 0
+        self.live = False
+        self.since = ""
+        self.proc = None
+        self._stop_handle = None
+
+    def subscribe(self, tail: int):
+        """Register a viewer; returns its queue and the last `tail` buffered lines."""
+        if self._stop_handle is not None:
+            self._stop_handle.cancel()
+            self._stop_handle = None
+        q: asyncio.Queue = asyncio.Queue(maxsize=LOG_VIEWER_QUEUE)
+        self.viewers.add(q)
+        backlog = list(self.lines)[-tail:] if tail > 0 else []
+        return q, backlog
+
+    def unsubscribe(self, q: asyncio.Queue):
+        self.viewers.discard(q)
+        if not self.viewers and not self.done and self._stop_handle is None:
+            self._stop_handle = asyncio.get_running_loop().call_later(LOG_FOLLOW_LINGER, self.stop)
+
+    def stop(self):
+        self._stop_handle = None
+        if self.viewers:
+            return
+        # unregister first so a new viewer starts a fresh follower
+        if _log_followers.get(self.name) is self:
+            del _log_followers[self.name]
+        if self.proc is not None and self.proc.returncode is None:
+            self.proc.kill()
+
+    async def _read(self, stream, kind: str):
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # longer than LOG_READ_LIMIT; asyncio has discarded it
+                msg = {"type": kind, "time": "", "data": "[line too long]\n"}
+            else:
+                if not line:
+                    return
+                msg = _log_line(kind, line)
+                if msg["time"] >= self.since:
+                    self.live = True
+            self.received += 1
+            self.lines.append(msg)
+            if self.primed.is_set():
+                for q in list(self.viewers):
+                    _offer_line(q, msg)
+
+    async def run(self):
+        readers = []
+        try:
+            self.since = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")
+            self.proc = await asyncio.create_subprocess_exec(
+                "docker", "logs", "-f", "--timestamps", "--tail", str(LOG_BUFFER_LINES), self.cname,
+                stdout=PIPE, stderr=PIPE, limit=LOG_READ_LIMIT)
+            logging.info("CMD: docker logs -f %s (%s viewers)", self.cname, len(self.viewers))
+            readers = [asyncio.create_task(self._read(self.proc.stdout, "stdout")),
+                       asyncio.create_task(self._read(self.proc.stderr, "stderr"))]
+            seen = 0
+            deadline = time.monotonic() + LOG_PRIME_TIMEOUT
+            while not self.live and time.monotonic() < deadline and not all(r.done() for r in readers):
+                await asyncio.sleep(LOG_PRIME_QUIET)
+                if self.received and self.received == seen:
+                    break
+                seen = self.received
+            # stdout and stderr are read separately; put the tail back in order
+            self.lines = deque(sorted(self.lines, key=lambda l: l["time"]), maxlen=LOG_BUFFER_LINES)
+            self.primed.set()
+            await asyncio.gather(*readers)
+            rc = await self.proc.wait()
+            logging.info("docker logs -f %s ended RETURN: %s", self.cname, rc)
+        except FileNotFoundError:
+            logging.error("docker command not found when following logs of %s", self.name)
+        except Exception:
+            logging.exception("log follower for %s failed", self.name)
+        finally:
+            for r in readers:
+                r.cancel()
+            if self.proc is not None and self.proc.returncode is None:
+                self.proc.kill()
+            self.done = True
+            self.primed.set()
+            if _log_followers.get(self.name) is self:
+                del _log_followers[self.name]
+            for q in list(self.viewers):
+                _offer_line(q, {"type": "end"})
+
+
+async def follow_container_logs(name: str, cname: str, tail: int):
+    """Yield the last `tail` lines of a container's log, then new lines as
+    they arrive, ending with {type: 'end'} when the container stops."""
+    follower = _log_followers.get(name)
+    if follower is None:
+        follower = _log_followers[name] = LogFollower(name, cname)
+        _start_background(follower.run())
+    await follower.primed.wait()
+    q, backlog = follower.subscribe(tail)
+    try:
+        for msg in backlog:
+            yield msg
+        if follower.done:
+            yield {"type": "end"}
+            return
+        while True:
+            msg = await q.get()
+            yield msg
+            if msg["type"] == "end":
+                return
+    finally:
+        follower.unsubscribe(q)
+
+
+def read_container_logs(name: str, cname: str, tail: int) -> dict:
+    """Last `tail` lines of a container's log, from a running follower's
+    buffer when it holds them and from one `docker logs` call otherwise."""
+    follower = _log_followers.get(name)
+    if follower is not None and follower.primed.is_set() and not follower.done \
+            and (tail <= len(follower.lines) or len(follower.lines) < LOG_BUFFER_LINES):
+        return {"source": "buffer", "lines": list(follower.lines)[-tail:] if tail > 0 else []}
+    cmd = ["docker", "logs", "--timestamps", "--tail", str(tail), cname]
+    try:
+        proc = subprocess.run(cmd, capture_output=True, timeout=30, check=False)
+    except FileNotFoundError:
+        raise HTTPException(status_code=500, detail="docker command not found")
+    except subprocess.TimeoutExpired:
+        raise HTTPException(status_code=504, detail="docker logs timed out")
+    logging.info("CMD: %s RETURN: %s", " ".join(cmd), proc.returncode)
+    if proc.returncode != 0:
+        raise HTTPException(status_code=500, detail=proc.stderr.decode(errors="replace").strip() or "docker logs failed")
+    # stdout and stderr come back separately; the timestamps merge them in order
+    lines = [_log_line(kind, raw) for kind, out in (("stdout", proc.stdout), ("stderr", proc.stderr))
+             for raw in out.splitlines(keepends=True)]
+    lines.sort(key=lambda l: l["time"])
+    return {"source": "docker", "lines": lines[-tail:] if tail > 0 else []}
+
+
+def _log_target(name: str) -> str:
+    if not (CONTAINERS_DIR / name).exists():
+        raise HTTPException(status_code=404, detail="not found")
+    # viewers joining a running follower don't need another `docker ps`
+    follower = _log_followers.get(name)
+    cname = follower.cname if follower is not None else resolve_container_name(name)
+    if not cname:
+        raise HTTPException(status_code=404, detail="container not found")
+    return cname
+
+
+@app.get('/api/containers/{name}/logs')
+async def get_container_logs(name: str, request: Request, tail: int = 200, follow: bool = False):
+    """Last `tail` lines of the container's `docker logs` as
+    {source, lines: [{type: 'stdout'|'stderr', time, data}]}. With follow=true the
+    lines are streamed as NDJSON instead, one line per message (same messages as
+    the WebSocket endpoint). That needs the Authorization header, so browsers use
+    fetch() or the WebSocket; EventSource can't send it."""
+    cname = await asyncio.to_thread(_log_target, name)
+    if not follow:
+        tail = max(0, min(tail, LOG_TAIL_MAX))
+        result = await asyncio.to_thread(read_container_logs, name, cname, tail)
+        return encode_response(request, json_bytes(result))
+
+    async def lines():
+        async for msg in follow_container_logs(name, cname, max(0, min(tail, LOG_BUFFER_LINES))):
+            yield json_bytes(msg) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={"Cache-Control": "no-cache"})
+
+
+@app.websocket('/api/containers/{name}/logs')
+async def container_logs_ws(websocket: WebSocket, name: str):
+    """WebSocket log follower.
+    Client should connect to: ws://host/api/containers/{name}/logs?token=<token>[&tail=200]
+    The server sends the last `tail` lines and then new ones as they arrive:
+      {type: 'stdout'|'stderr', time: '2026-10-19T03:00:00.123456', data: '...'}
+      {type: 'lagged', dropped: 12}  (client was too slow; those lines are skipped)
+      {type: 'end'}  (the container stopped; the server closes the socket)
+    """
+    token = websocket.query_params.get('token')
+    user = _validate_token(token) if token else None
+    if not user:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    tail = websocket.query_params.get('tail', '200')
+    tail = max(0, min(int(tail), LOG_BUFFER_LINES)) if tail.isdigit() else 200
+    try:
+        cname = await asyncio.to_thread(_log_target, name)
+    except HTTPException as e:
+        await websocket.send_json({'type': 'error', 'detail': e.detail})
+        await websocket.close()
+        return
+
+    async def pump():
+        async for msg in follow_container_logs(name, cname, tail):
+            await websocket.send_json(msg)
+
+    async def until_disconnect():
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    # the client sends nothing; waiting on receive() notices a disconnect even
+    # while the container is silent
+    sender = asyncio.create_task(pump())
+    receiver = asyncio.create_task(until_disconnect())
+    try:
+        done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+        if sender in done and sender.exception() is None:
+            await websocket.close()
+    except Exception:
+        logging.exception('container log stream failed')
+    finally:
+        sender.cancel()
+        receiver.cancel()
+        await asyncio.gather(sender, receiver, return_exceptions=True)
+
+
+# Fan-out exec
+#
+# Runs one command in many containers: targets come from the cached fleet list
+# plus a single `docker ps -a`, at most `parallelism` execs run at once, each
+# bounded by `timeout` seconds. Results are yielded as each container finishes
+# and recorded in that container's exec log.
+FANOUT_PARALLELISM = int(os.environ.get("VDESK_FANOUT_PARALLELISM", "8"))
+FANOUT_TIMEOUT = float(os.environ.get("VDESK_FANOUT_TIMEOUT", "60"))
+
+
+class FanoutExec(BaseModel):
+    cmd: str
+    # selectors; all given ones must match, none given means every container
+    names: Optional[List[str]] = None
+    image: Optional[str] = Field(None, description="substring of the image name")
+    state: Optional[str] = Field(None, description="running, stopped or a docker status prefix")
+    parallelism: Optional[int] = None
+    timeout: Optional[float] = None
+
+
+def _state_matches(status: str, wanted: str) -> bool:
+    running = status.startswith("Up")
+    wanted = wanted.lower()
+    if wanted == "running":
+        return running
+    if wanted == "stopped":
+        return not running
+    return status.lower().startswith(wanted)
+
+
+def select_fanout_targets(payload: FanoutExec) -> List[dict]:
+    """Return [{name, container}] for the selected containers; container is the
+    running docker container name or None."""
+    _, items = get_fleet()
+    projects = _docker_ps_projects()
+    names = set(payload.names) if payload.names else None
+    targets = []
+    for item in items:
+        if names is not None and item["name"] not in names:
+            continue
+        if payload.image and payload.image not in (item.get("image") or ""):
+            continue
+        if payload.state and not _state_matches(item.get("state") or "idle", payload.state):
+            continue
+        running = [c["name"] for c in projects.get(item["name"], []) if c["running"]]
+        targets.append({"name": item["name"], "container": running[0] if running else None})
+    return targets
+
+
+def _kill_session(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def _fanout_one(target: dict, cmd: str, timeout: float, user: Optional[str]) -> dict:
+    name, cname = target["name"], target["container"]
+    start = time.monotonic()
+    if cname is None:
+        return {"type": "result", "name": name, "returncode": None, "stdout": "", "stderr": "",
+                "error": "not running", "duration": 0.0}
+    timed_out = False
+    try:
+        async with container_lock_async(name, shared=True, timeout=timeout):
+            # own process group so a timeout kills the whole exec client tree
+            proc = await asyncio.create_subprocess_exec(
+                "docker", "exec", "-u", "root", cname, "/bin/bash", "-c", cmd,
+                stdout=PIPE, stderr=PIPE, start_new_session=True)
+            try:
+                out, err = await asyncio.wait_for(proc.communicate(), timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+                _kill_session(proc)
+                out, err = await proc.communicate()
+            except asyncio.CancelledError:
+                # the fan-out was abandoned (client went away); cancelling
+                # communicate() alone would leave the exec running. Starlette
+                # cancels through an anyio scope, which would cancel the reap
+                # too, so shield it and the bookkeeping.
+                with anyio.CancelScope(shield=True):
+                    _kill_session(proc)
+                    await proc.wait()
+                    duration = time.monotonic() - start
+                    logging.info("EXEC CMD: docker exec %s %s CANCELLED", cname, cmd)
+                    audit("exec", name, cmd, proc.returncode, duration, "", "cancelled", user=user, fanout=True)
+                    append_exec_log(name, user, cmd, proc.returncode, "", "cancelled")
+                raise
+    except ContainerBusy:
+        return {"type": "result", "name": name, "returncode": None, "stdout": "", "stderr": "",
+                "error": "container is busy", "duration": round(time.monotonic() - start, 3)}
+    duration = time.monotonic() - start
+    stdout, stderr = out.decode(errors="replace"), err.decode(errors="replace")
+    returncode = 124 if timed_out else proc.returncode
+    if timed_out:
+        stderr += f"\ntimed out after {timeout}s"
+    logging.info("EXEC CMD: docker exec %s %s RETURN: %s", cname, cmd, returncode)
+    audit("exec", name, cmd, returncode, duration, stdout, stderr, user=user, fanout=True)
+    await asyncio.to_thread(append_exec_log, name, user, cmd, returncode, stdout, stderr)
+    result = {"type": "result", "name": name, "returncode": returncode, "stdout": stdout,
+              "stderr": stderr, "duration": round(duration, 3)}
+    if timed_out:
+        result["error"] = "timeout"
+    return result
+
+
+async def fanout_exec(payload: FanoutExec, user: Optional[str]):
+    """Async generator of fan-out messages: one `start`, a `result` per target
+    in completion order, and a final `done` summary."""
+    targets = await asyncio.to_thread(select_fanout_targets, payload)
+    parallelism = max(1, payload.parallelism or FANOUT_PARALLELISM)
+    timeout = payload.timeout or FANOUT_TIMEOUT
+    yield {"type": "start", "cmd": payload.cmd, "targets": [t["name"] for t in targets],
+           "parallelism": parallelism, "timeout": timeout}
+    sem = asyncio.Semaphore(parallelism)
+
+    async def run(target):
+        async with sem:
+            return await _fanout_one(target, payload.cmd, timeout, user)
+
+    start = time.monotonic()
+    ok = failed = 0
+    finished = False
+    tasks = [asyncio.create_task(run(t)) for t in targets]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            result = await next_done
+            if result["returncode"] == 0:
+                ok += 1
+            else:
+                failed += 1
+            yield result
+        finished = True
+    finally:
+        # client went away: stop the remaining execs and wait until they are
+        # killed and recorded, shielded from the request's cancel scope
+        with anyio.CancelScope(shield=True):
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        duration = time.monotonic() - start
+        extra = {} if finished else {"cancelled": len(targets) - ok - failed}
+        audit("exec_fanout", detail=payload.cmd, returncode=1 if failed or not finished else 0,
+              duration=duration, user=user, targets=len(targets), failed=failed, **extra)
+    yield {"type": "done", "total": len(targets), "ok": ok, "failed": failed,
+           "duration": round(duration, 3)}
+
+
+@app.post('/api/exec')
+async def exec_fanout(payload: FanoutExec, request: Request):
+    """Run a command in every selected container; streams NDJSON, one line per message."""
+    user = getattr(request.state, 'user', None)
+
+    async def lines():
+        async for msg in fanout_exec(payload, user):
+            yield json.dumps(msg) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.websocket('/api/exec-ws')
+async def exec_fanout_ws(websocket: WebSocket):
+    """WebSocket variant of POST /api/exec: connect with ?token=, send the request
+    body as JSON, receive the same messages as JSON frames."""
+    token = websocket.query_params.get('token')
+    user = _validate_token(token) if token else None
+    if not user:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    try:
+        try:
+            payload = FanoutExec(**await websocket.receive_json())
+        except Exception as e:
+            await websocket.send_json({'type': 'error', 'detail': str(e)})
+            await websocket.close()
+            return
+        async for msg in fanout_exec(payload, user):
+            await websocket.send_json(msg)
+        await websocket.close()
+    except WebSocketDisconnect:
+        return
+
+
+def _parse_time(value: str) -> float:
+    """Parse an epoch number or ISO 8601 timestamp (UTC if no offset) to epoch seconds."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+@app.get('/api/audit')
+def query_audit(request: Request, user: Optional[str] = None, container: Optional[str] = None, action: Optional[str] = None,
+                since: Optional[str] = None, until: Optional[str] = None,
+                before: Optional[int] = None, limit: int = 100, output: bool = False):
+    """Return audit events, newest first. Paginate by passing the returned
+    `next` value as `before`. Command output is included only with output=true.
+    """
+    where, args = [], []
+    for column, value in (("user", user), ("container", container), ("action", action)):
+        if value:
+            where.append(f"{column} = ?")
+            args.append(value)
+    try:
+        if since:
+            where.append("ts >= ?")
+            args.append(_parse_time(since))
+        if until:
+            where.append("ts < ?")
+            args.append(_parse_time(until))
+    except ValueError:
+        raise HTTPException(status_code=400, detail='invalid since/until')
+    if before is not None:
+        where.append("id < ?")
+        args.append(before)
+    limit = max(1, min(limit, 1000))
+    sql = "SELECT * FROM events"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id DESC LIMIT ?"
+    with _audit_lock:
+        rows = audit_db.execute(sql, args + [limit]).fetchall()
+    items = [_audit_row(r, output) for r in rows]
+    return encode_response(request, json_bytes({"items": items, "next": items[-1]["id"] if len(items) == limit else None}))
+
+
+@app.get('/api/audit/{event_id}')
+def get_audit_event(event_id: int):
+    """Return one audit event including its (truncated) command output."""
+    with _audit_lock:
+        row = audit_db.execute("SELECT * FROM events WHERE id = ?", (event_id,)).fetchone()
+    if row is None:
+        raise HTTPException(status_code=404, detail='not found')
+    return _audit_row(row, True)
+
+
 # Simple in-memory auth (demo). Replace with real auth in production.
-USERS_FILE = WEB_ROOT / "users.json"
+USERS_FILE = Path(os.environ.get("VDESK_USERS_FILE", str(WEB_ROOT / "users.json")))
 
 
 def load_users():
@@ -790,8 +3450,8 @@ def set_user_password(username: str, password: str):
     save_users(users)
 
 
-# load users into memory; authentication checks will read from USERS for simplicity
-USERS: Dict[str, str] = load_users()
+# loaded into memory by startup(); authentication checks will read from USERS for simplicity
+USERS: Dict[str, str] = {}
 TOKENS: Dict[str, dict] = {}  # token -> {user, exp}
 
 
@@ -821,10 +3481,13 @@ def api_login(payload: dict):
     # expected is a bcrypt hash string; verify
     try:
         if expected is None or not bcrypt.checkpw(password.encode(), expected.encode()):
+            audit("login_failed", user=username)
             raise HTTPException(status_code=401, detail="invalid credentials")
     except ValueError:
         # invalid hash format
+        audit("login_failed", user=username)
         raise HTTPException(status_code=401, detail="invalid credentials")
+    audit("login", user=username)
     token = _create_token(username)
     return {"token": token, "user": username}
 
@@ -877,13 +3540,20 @@ def change_password(payload: ChangePasswordModel, request: Request):
     except Exception:
         logging.exception('failed to invalidate tokens for user %s', username)
 
+    audit("change_password", user=username)
     return {'result': 'ok', 'message': 'password changed; please re-login'}
 
 
+@app.exception_handler(ContainerBusy)
+async def container_busy_handler(request: Request, exc: ContainerBusy):
+    return JSONResponse(status_code=409, content={"detail": f"container {exc} is busy, try again"})
+
+
 @app.middleware("http")
 async def auth_middleware(request: Request, call_next):
     # allow public paths
-    public_prefixes = ("/api/login", "/api/images", "/api/openapi.json", "/docs", "/favicon.ico", "/static", "/api/host")
+    public_prefixes = ("/api/login", "/api/images", "/api/openapi.json", "/docs", "/favicon.ico", "/static", "/api/host",
+                       "/healthz", "/readyz")
     path = request.url.path
     for p in public_prefixes:
         if path.startswith(p):
@@ -897,6 +3567,7 @@ async def auth_middleware(request: Request, call_next):
         return Response(status_code=401, content="unauthorized")
     # attach user info to request.state if handlers need it
     request.state.user = user
+    current_user.set(user)
     return await call_next(request)
 
 
@@ -923,6 +3594,59 @@ def set_env_key_in_list(env_list, key, val):
         env_list.append(f"{key}={val}")
 
 
+@app.websocket('/api/containers/feed')
+async def container_feed(websocket: WebSocket):
+    """WebSocket change feed of the container list.
+    Client should connect to: ws://host/api/containers/feed?token=<token>[&since=<version>&epoch=<epoch>]
+    The server first sends either the missed deltas (when `epoch` is this
+    process's and `since` is still in the backlog) or a snapshot, then one
+    message per change:
+      {type: 'snapshot', epoch: '...', version: 12, items: [...]}
+      {type: 'delta', version: 13, event: 'create|modify|state|delete', name: '123456', item: {...}|null}
+      {type: 'resync'}  (client fell behind and should reconnect without `since`)
+    """
+    token = websocket.query_params.get('token')
+    user = _validate_token(token) if token else None
+    if not user:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    q: asyncio.Queue = asyncio.Queue(maxsize=FLEET_FEED_QUEUE)
+    # subscribe before taking the snapshot so no change falls in between
+    _feed_subscribers.add(q)
+    try:
+        since = websocket.query_params.get('since')
+        backlog = list(_feed_backlog)
+        sent = None
+        same_process = websocket.query_params.get('epoch') == FLEET_EPOCH
+        if same_process and since is not None and since.isdigit() and int(since) <= _fleet["version"]:
+            since = int(since)
+            if since == _fleet["version"] or (backlog and backlog[0]["version"] <= since + 1):
+                for event in backlog:
+                    if event["version"] > since:
+                        await websocket.send_json(event)
+                sent = max([since] + [e["version"] for e in backlog])
+        if sent is None:
+            version, items = await asyncio.to_thread(get_fleet)
+            await websocket.send_json({"type": "snapshot", "epoch": FLEET_EPOCH, "version": version, "items": items})
+            sent = version
+        while True:
+            event = await q.get()
+            if event.get("type") == "delta" and event["version"] <= sent:
+                continue
+            await websocket.send_json(event)
+            if event.get("type") == "resync":
+                await websocket.close()
+                return
+            sent = event["version"]
+    except WebSocketDisconnect:
+        return
+    except Exception:
+        logging.exception('container feed failed')
+    finally:
+        _feed_subscribers.discard(q)
+
+
 @app.websocket('/api/containers/{name}/exec-ws')
 async def exec_in_container_ws(websocket: WebSocket, name: str):
     """WebSocket endpoint to run a command inside a container and stream stdout/stderr.
@@ -952,6 +3676,11 @@ async def exec_in_container_ws(websocket: WebSocket, name: str):
             await websocket.close()
             return
 
+        if not (CONTAINERS_DIR / name).is_dir():
+            await websocket.send_json({'type': 'error', 'detail': 'container not found or not running'})
+            await websocket.close()
+            return
+
         # find target container name
         target_cname = None
         try:
@@ -971,36 +3700,47 @@ async def exec_in_container_ws(websocket: WebSocket, name: str):
         # use bash -lc to allow complex commands
         full_cmd = f"docker exec -u root {shlex.quote(target_cname)} /bin/bash -lc {shlex.quote(cmd)}"
 
-        # start subprocess
-        proc = await asyncio.create_subprocess_shell(full_cmd, stdout=PIPE, stderr=PIPE)
-
-        stdout_acc = []
-        stderr_acc = []
-
-        async def read_stream(stream, kind):
-            while True:
-                line = await stream.readline()
-                if not line:
-                    break
-                text = line.decode(errors='replace')
-                if kind == 'stdout':
-                    stdout_acc.append(text)
-                else:
-                    stderr_acc.append(text)
-                try:
-                    await websocket.send_json({'type': kind, 'data': text})
-                except Exception:
-                    # client disconnected
-                    break
-
-        # concurrently read stdout and stderr
-        tasks = [asyncio.create_task(read_stream(proc.stdout, 'stdout')),
-                 asyncio.create_task(read_stream(proc.stderr, 'stderr'))]
-
-        # wait for process to finish
-        returncode = await proc.wait()
-        # wait for readers to finish
-        await asyncio.gather(*tasks)
+        # start subprocess; shares the container lock with other execs so it
+        # cannot run while the compose file is being rewritten
+        try:
+            async with container_lock_async(name, shared=True):
+                exec_start = time.monotonic()
+                proc = await asyncio.create_subprocess_shell(full_cmd, stdout=PIPE, stderr=PIPE)
+
+                stdout_acc = []
+                stderr_acc = []
+
+                async def read_stream(stream, kind):
+                    while True:
+                        line = await stream.readline()
+                        if not line:
+                            break
+                        text = line.decode(errors='replace')
+                        if kind == 'stdout':
+                            stdout_acc.append(text)
+                        else:
+                            stderr_acc.append(text)
+                        try:
+                            await websocket.send_json({'type': kind, 'data': text})
+                        except Exception:
+                            # client disconnected
+                            break
+
+                # concurrently read stdout and stderr
+                tasks = [asyncio.create_task(read_stream(proc.stdout, 'stdout')),
+                         asyncio.create_task(read_stream(proc.stderr, 'stderr'))]
+
+                # wait for process to finish
+                returncode = await proc.wait()
+                # wait for readers to finish
+                await asyncio.gather(*tasks)
+        except ContainerBusy:
+            await websocket.send_json({'type': 'error', 'detail': 'container is busy'})
+            await websocket.close()
+            return
+        logging.info("EXEC-WS CMD: docker exec %s %s RETURN: %s", target_cname, cmd, returncode)
+        audit("exec", name, cmd, returncode, time.monotonic() - exec_start,
+              ''.join(stdout_acc), ''.join(stderr_acc), user=user, stream=True)
 
         # send exit frame
         try:
@@ -1009,33 +3749,8 @@ async def exec_in_container_ws(websocket: WebSocket, name: str):
             pass
 
         # append to exec log file
-        try:
-            path = CONTAINERS_DIR / name
-            logs_file = path / 'exec_logs.json'
-            entry = {
-                'id': uuid.uuid4().hex,
-                'timestamp': datetime.utcnow().isoformat() + 'Z',
-                'user': user,
-                'cmd': cmd,
-                'returncode': returncode,
-                'stdout': ''.join(stdout_acc),
-                'stderr': ''.join(stderr_acc),
-            }
-            logs = []
-            if logs_file.exists():
-                try:
-                    with logs_file.open() as f:
-                        logs = json.load(f)
-                except Exception:
-                    logs = []
-            logs.append(entry)
-            try:
-                with logs_file.open('w') as f:
-                    json.dump(logs, f)
-            except Exception:
-                logging.exception('failed to write exec logs for %s', name)
-        except Exception:
-            logging.exception('failed to append exec log')
+        await asyncio.to_thread(append_exec_log, name, user, cmd, returncode,
+                                ''.join(stdout_acc), ''.join(stderr_acc))
 
         await websocket.close()
     except WebSocketDisconnect:
@@ -1065,6 +3780,138 @@ def parse_memory_to_bytes(mem_str: str) -> int:
         return int(float(mem_str))
 
 
+# Startup and shutdown
+#
+# Importing this module has no side effects; the lifespan (see `lifespan` at
+# the top) creates directories, starts logging, then loads users, templates,
+# the audit store and the container list in parallel worker threads before
+# uvicorn starts serving. Step durations are logged and returned by /readyz.
+# /readyz answers 503 until that is done, so a load balancer only sends
+# traffic to fully warmed workers. uvicorn stops accepting connections as soon
+# as it gets SIGTERM and only then runs the lifespan shutdown, so startup()
+# wraps uvicorn's SIGTERM handler: /readyz turns 503 first and uvicorn is told
+# DRAIN_SECONDS later, giving the load balancer time to notice.
+_lifecycle = {"state": "starting", "started": time.time(), "ready_at": None, "profile": {}}
+DRAIN_SECONDS = float(os.environ.get("VDESK_DRAIN_SECONDS", "5"))
+
+
+async def _timed(step: str, fn, *args):
+    start = time.monotonic()
+    try:
+        return await asyncio.to_thread(fn, *args)
+    finally:
+        _lifecycle["profile"][step] = round(time.monotonic() - start, 3)
+
+
+def _start_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def _install_drain_handler():
+    # signal handlers can only be set from the main thread (not under TestClient)
+    if threading.current_thread() is not threading.main_thread():
+        return
+    previous = signal.getsignal(signal.SIGTERM)
+    if not callable(previous):
+        return
+
+    def on_sigterm(sig, frame):
+        if _lifecycle["state"] != "ready" or DRAIN_SECONDS <= 0:
+            # a second SIGTERM doesn't wait for the drain
+            previous(sig, frame)
+            return
+        _lifecycle["state"] = "stopping"
+        logging.info("SIGTERM: not ready, shutting down in %.0fs", DRAIN_SECONDS)
+        timer = threading.Timer(DRAIN_SECONDS, previous, (sig, frame))
+        timer.daemon = True
+        timer.start()
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+
+def _load_all_users():
+    global USERS
+    USERS = load_users()
+
+
+def _load_all_templates():
+    global TEMPLATES
+    TEMPLATES = load_templates()
+
+
+def _open_audit():
+    global audit_db
+    audit_db = _open_audit_db(AUDIT_DB)
+
+
+def _warm_container_list():
+    try:
+        refresh_fleet()
+    except Exception:
+        # the list is rebuilt on first use; docker may just not be up yet
+        logging.exception("failed to warm the container list")
+
+
+async def startup():
+    global log_queue_handler, log_listener, _event_loop
+    begin = time.monotonic()
+    _event_loop = asyncio.get_running_loop()
+    for d in (CONTAINERS_DIR, LOG_DIR):
+        d.mkdir(parents=True, exist_ok=True)
+    log_queue_handler, log_listener = setup_logging()
+    await asyncio.gather(
+        _timed("users", _load_all_users),
+        _timed("audit_db", _open_audit),
+        _timed("templates", _load_all_templates),
+        _timed("containers", _warm_container_list),
+    )
+    _start_background(_fleet_watch_loop())
+    if PROBE_INTERVAL > 0:
+        _start_background(_probe_loop())
+    if DISK_SCAN_INTERVAL > 0:
+        _start_background(_disk_scan_loop())
+    _start_background(_reconcile_loop())
+    _lifecycle["profile"]["total"] = round(time.monotonic() - begin, 3)
+    _lifecycle.update(state="ready", ready_at=time.time())
+    _install_drain_handler()
+    logging.info("startup finished in %.2fs (%s)", _lifecycle["profile"]["total"],
+                 ", ".join(f"{k} {v:.2f}s" for k, v in _lifecycle["profile"].items() if k != "total"))
+
+
+async def shutdown():
+    global audit_db, log_listener
+    _lifecycle["state"] = "stopping"
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    logging.info("shutting down")
+    if audit_db is not None:
+        with _audit_lock:
+            audit_db.close()
+            audit_db = None
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+
+@app.get('/healthz')
+def healthz():
+    """Liveness: the process is up and serving requests."""
+    return {"status": "ok", "uptime": round(time.time() - _lifecycle["started"], 3)}
+
+
+@app.get('/readyz')
+def readyz():
+    """Readiness: startup finished and not shutting down (503 otherwise)."""
+    body = {"status": _lifecycle["state"], "profile": _lifecycle["profile"]}
+    if _lifecycle["ready_at"] is not None:
+        body["ready_at"] = datetime.fromtimestamp(_lifecycle["ready_at"], timezone.utc).isoformat()
+    return JSONResponse(body, status_code=200 if _lifecycle["state"] == "ready" else 503)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,41 @@
+"""Incremental volume scans. Run with `pytest` from web/backend."""
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(main, "_dir_cache", {})
+
+
+def touch_tree(root: Path):
+    for d in ("home/a/deep", "home/b", "tmp"):
+        (root / d).mkdir(parents=True)
+        (root / d / "f").write_text("x" * 5000)
+
+
+def test_scan_tree_reuses_unchanged_dirs(tmp_path):
+    touch_tree(tmp_path)
+    first = main.scan_tree(str(tmp_path), main._Throttle(0))
+    assert first["files"] == 3 and first["dirs"] == 6 and first["reused"] == 0
+    second = main.scan_tree(str(tmp_path), main._Throttle(0))
+    assert second["bytes"] == first["bytes"]
+    assert second["reused"] == 6
+
+
+def test_scan_tree_forgets_deleted_subtrees(tmp_path):
+    touch_tree(tmp_path)
+    main.scan_tree(str(tmp_path), main._Throttle(0))
+    shutil.rmtree(tmp_path / "home" / "a")
+    usage = main.scan_tree(str(tmp_path), main._Throttle(0))
+    assert usage["files"] == 2
+    assert not [p for p in main._dir_cache if p.startswith(os.path.join(str(tmp_path), "home", "a"))]
+    assert len(main._dir_cache) == usage["dirs"] == 4
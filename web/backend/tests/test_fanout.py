@@ -0,0 +1,67 @@
+"""Fan-out exec against a stub docker client. Run with `pytest` from web/backend."""
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import anyio
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+
+NAMES = ["100001", "100002", "100003"]
+
+
+@pytest.fixture
+def fleet(tmp_path, monkeypatch):
+    """Three running containers whose `docker exec` hangs until killed."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    started = tmp_path / "started"
+    docker = bin_dir / "docker"
+    docker.write_text(f"#!/bin/sh\necho \"$3\" >> {started}\nexec sleep 30\n")
+    docker.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    for name in NAMES:
+        (tmp_path / "containers" / name).mkdir(parents=True)
+    monkeypatch.setattr(main, "CONTAINERS_DIR", tmp_path / "containers")
+    monkeypatch.setattr(main, "LOCK_DIR", tmp_path)
+    monkeypatch.setattr(main, "BLOB_DIR", tmp_path / "blobs")
+    monkeypatch.setattr(main, "audit_db", main._open_audit_db(tmp_path / "audit.db"))
+    monkeypatch.setattr(main, "select_fanout_targets",
+                        lambda payload: [{"name": n, "container": f"{n}-my_ws-1"} for n in NAMES])
+    return started
+
+
+def test_cancelled_fanout_is_killed_and_recorded(fleet):
+    payload = main.FanoutExec(cmd="sleep 30")
+
+    async def scenario():
+        async with anyio.create_task_group() as tg:
+            async def consume():
+                async for _ in main.fanout_exec(payload, "admin"):
+                    pass
+
+            tg.start_soon(consume)
+            # cancel the way Starlette does when the client disconnects
+            with anyio.fail_after(10):
+                while not fleet.exists() or len(fleet.read_text().split()) < len(NAMES):
+                    await anyio.sleep(0.05)
+            tg.cancel_scope.cancel()
+
+    start = time.monotonic()
+    anyio.run(scenario)
+    assert time.monotonic() - start < 10
+
+    for name in NAMES:
+        logs = json.loads((main.CONTAINERS_DIR / name / "exec_logs.json").read_text())
+        assert [(e["cmd"], e["stderr_preview"]) for e in logs] == [("sleep 30", "cancelled")]
+    rows = main.audit_db.execute("SELECT action, container, stderr, extra FROM events ORDER BY id").fetchall()
+    assert sorted(r["container"] for r in rows if r["action"] == "exec") == NAMES
+    assert all(r["stderr"] == "cancelled" for r in rows if r["action"] == "exec")
+    summary = [r for r in rows if r["action"] == "exec_fanout"]
+    assert len(summary) == 1
+    assert json.loads(summary[0]["extra"])["cancelled"] == len(NAMES)
@@ -0,0 +1,122 @@
+"""NUMA placement against a fake sysfs tree. Run with `pytest` from web/backend."""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+
+
+def make_sysfs(root: Path, nodes: dict, gpus: list, other_devices: list = ()):
+    """nodes: node -> cpulist text; gpus: NVIDIA (pci address, numa node, class)
+    in any order; other_devices: (pci address, numa node, class, vendor)."""
+    for node, cpulist in nodes.items():
+        d = root / "devices" / "system" / "node" / f"node{node}"
+        d.mkdir(parents=True)
+        (d / "cpulist").write_text(cpulist + "\n")
+    for addr, node, pci_class, vendor in [(a, n, c, main.NVIDIA_PCI_VENDOR) for a, n, c in gpus] + list(other_devices):
+        d = root / "bus" / "pci" / "devices" / addr
+        d.mkdir(parents=True)
+        (d / "vendor").write_text(vendor + "\n")
+        (d / "class").write_text(pci_class + "\n")
+        (d / "numa_node").write_text(f"{node}\n")
+    return root
+
+
+@pytest.mark.parametrize("text,cpus", [
+    ("0-3,8,10-11", [0, 1, 2, 3, 8, 10, 11]),
+    ("5", [5]),
+    ("", []),
+    (" 0-1 ,\n", [0, 1]),
+])
+def test_parse_cpulist(text, cpus):
+    assert main.parse_cpulist(text) == cpus
+
+
+def test_format_cpulist_roundtrip():
+    assert main.format_cpulist([11, 0, 1, 2, 3, 8, 10]) == "0-3,8,10-11"
+    assert main.parse_cpulist(main.format_cpulist([7, 4, 5])) == [4, 5, 7]
+
+
+def test_read_numa_topology(tmp_path):
+    make_sysfs(tmp_path, {0: "0-3", 1: "4-7"}, [])
+    assert main.read_numa_topology(tmp_path) == {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]}
+
+
+def test_read_numa_topology_without_nodes_uses_online_cpus(tmp_path):
+    cpu = tmp_path / "devices" / "system" / "cpu"
+    cpu.mkdir(parents=True)
+    (cpu / "online").write_text("0-5\n")
+    assert main.read_numa_topology(tmp_path) == {0: [0, 1, 2, 3, 4, 5]}
+
+
+def test_read_gpu_numa_nodes_orders_by_pci_address(tmp_path):
+    make_sysfs(tmp_path, {0: "0-3", 1: "4-7"},
+               [("0000:c1:00.0", 1, "0x030200"), ("0000:41:00.0", 0, "0x030000"), ("0000:81:00.0", -1, "0x030200")],
+               # an NVIDIA audio function and a non-NVIDIA GPU are not counted
+               other_devices=[("0000:41:00.1", 0, "0x040300", main.NVIDIA_PCI_VENDOR),
+                              ("0000:03:00.0", 0, "0x030000", "0x1a03")])
+    assert main.read_gpu_numa_nodes(tmp_path) == {0: 0, 1: None, 2: 1}
+
+
+NODES = {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]}
+GPU_NODES = {0: 0, 1: 1}
+
+
+def test_plan_placement_prefers_gpu_local_node():
+    placement = main.plan_placement(2, [1], NODES, GPU_NODES, set())
+    assert placement == {"cpuset": "4-5", "mems": "1", "gpu_local": True}
+
+
+def test_plan_placement_skips_used_cpus():
+    placement = main.plan_placement(2, [0], NODES, GPU_NODES, {0, 1})
+    assert placement["cpuset"] == "2-3"
+
+
+def test_plan_placement_without_gpus_picks_the_fullest_fit():
+    # node 0 has 2 free cores, node 1 has 4: a 2-cpu desktop fills node 0 up
+    placement = main.plan_placement(2, [], NODES, GPU_NODES, {0, 1})
+    assert placement["cpuset"] == "2-3"
+    assert placement["gpu_local"] is False
+
+
+def test_plan_placement_spreads_when_no_node_fits():
+    placement = main.plan_placement(6, [0], NODES, GPU_NODES, set())
+    assert placement["cpuset"] == "0-5"
+    assert placement["mems"] == "0-1"
+    assert placement["gpu_local"] is False
+
+
+def test_plan_placement_returns_none_when_cpus_do_not_fit():
+    assert main.plan_placement(3, [], NODES, GPU_NODES, {0, 1, 2, 4, 5, 6}) is None
+    assert main.plan_placement(0, [], NODES, GPU_NODES, set()) is None
+
+
+def test_place_container_uses_sysfs_and_assigned_cpusets(tmp_path, monkeypatch):
+    sysfs = make_sysfs(tmp_path / "sys", {0: "0-3", 1: "4-7"},
+                       [("0000:41:00.0", 0, "0x030200"), ("0000:c1:00.0", 1, "0x030200")])
+    containers = tmp_path / "containers"
+    existing = containers / "100001"
+    existing.mkdir(parents=True)
+    (existing / "docker-compose.yml").write_text("services:\n  my_ws:\n    cpuset: '4-5'\n")
+    monkeypatch.setattr(main, "SYSFS_ROOT", sysfs)
+    monkeypatch.setattr(main, "CONTAINERS_DIR", containers)
+    monkeypatch.setattr(main, "PLACEMENT_ENABLED", True)
+    assert main.assigned_cpusets() == {"100001": [4, 5]}
+    placement = main.place_container("100002", 2, [1])
+    assert placement["cpuset"] == "6-7"
+    # a container's own cpuset doesn't count as used when it is re-placed
+    assert main.place_container("100001", 2, [1])["cpuset"] == "4-5"
+
+
+def test_placement_lock_excludes_other_holders(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "LOCK_DIR", tmp_path)
+    with main.placement_lock():
+        # a second holder opens its own descriptor, like another worker process would
+        with pytest.raises(main.ContainerBusy):
+            with main.placement_lock(timeout=0.1):
+                pass
+    with main.placement_lock(timeout=0.1):
+        pass